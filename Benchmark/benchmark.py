@@ -0,0 +1,186 @@
+'''
+Benchmark for duetBackup
+Runs duetBackup.py against a stand-in printer (fakeDuet.py) and Github (fakeGithub.py) over synthetic SD cards
+For each size, three backups are run:
+cold - empty repository, no manifest or cache
+incremental - about 1% of the files changed, added and deleted
+nochange - nothing changed since the last backup
+Reports wall time, peak memory (RSS), calls per endpoint and bytes moved for each backup
+
+Usage e.g.
+python3 benchmark.py
+python3 benchmark.py -sizes 10 1000 -latency 0.01 -json results.json
+Everything after -- is passed to duetBackup.py e.g. -- -readmeOnChange
+'''
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import fakeDuet
+import fakeGithub
+
+benchDir = os.path.dirname(os.path.abspath(__file__))
+defaultCode = os.path.join(benchDir, '..', 'plugin3.6.x', 'Code', 'dsf', 'duetBackup.py')
+states = ['cold', 'incremental', 'nochange']
+
+def init():
+	parser = argparse.ArgumentParser(description='duetBackup benchmark')
+	parser.add_argument('-sizes', type=int, nargs='+', default=[10, 1000, 10000], help='Number of files on each SD card')
+	parser.add_argument('-latency', type=float, default=0.0, help='Seconds added to every printer request')
+	parser.add_argument('-githubLatency', type=float, default=0.0, help='Seconds added to every Github request')
+	parser.add_argument('-page', type=int, default=50, help='Entries per rr_filelist call')
+	parser.add_argument('-maxConnections', type=int, default=4, help='Printer requests in progress before 503')
+	parser.add_argument('-protocol', choices=['rr', 'dsf'], default='rr', help='rr - standalone board, dsf - SBC')
+	parser.add_argument('-sink', choices=['api', 'mirror'], default='api', help='mirror pushes to a local bare repository')
+	parser.add_argument('-truncate', type=int, default=100000, help='Entries in a recursive tree before Github truncates it')
+	parser.add_argument('-code', type=str, default=defaultCode, help='duetBackup.py to run')
+	parser.add_argument('-json', type=str, default='', help='Also write the results to this file')
+	parser.add_argument('-keep', action='store_true', help='Keep the working directory')
+	parser.add_argument('extra', nargs='*', help='Options passed to duetBackup.py (after --)')
+	return parser.parse_args()
+
+def makeSdCard(root, count, rng):
+	# Mostly small gcode macros with some larger text and binary files, 100 to a folder
+	os.makedirs(os.path.join(root, 'sys'))
+	os.makedirs(os.path.join(root, 'macros'))
+	for i in range(count):
+		folder = os.path.join(root, 'macros' if i % 3 == 0 else 'sys', f'''d{i // 100:03d}''')
+		os.makedirs(folder, exist_ok=True)
+		writeFile(folder, i, rng)
+
+def writeFile(folder, i, rng):
+	kind = i % 20
+	if kind == 0:
+		name, data = f'''f{i:05d}.bin''', rng.randbytes(rng.randint(1024, 64*1024))
+	elif kind == 1:
+		name, data = f'''f{i:05d}.g''', gcode(rng, rng.randint(2000, 4000)) # 100KB or so
+	else:
+		name, data = f'''f{i:05d}.g''', gcode(rng, rng.randint(5, 50))
+	with open(os.path.join(folder, name), 'wb') as f:
+		f.write(data)
+
+def gcode(rng, lines):
+	return ''.join(f'''G1 X{rng.uniform(0, 300):.3f} Y{rng.uniform(0, 300):.3f} E{rng.uniform(0, 5):.4f}\n''' for i in range(lines)).encode('ascii')
+
+def changeSdCard(root, rng):
+	# About 1% of the files changed, added and deleted - at least one of each
+	files = sorted(os.path.join(d, f) for d, subdirs, names in os.walk(root) for f in names)
+	n = max(1, len(files) // 100)
+	picked = rng.sample(files, min(len(files), 2*n))
+	for path in picked[:n]:
+		with open(path, 'ab') as f:
+			f.write(b'; changed\n')
+	for path in picked[n:]:
+		os.remove(path)
+	for i in range(n):
+		writeFile(os.path.dirname(files[0]), 100000 + i, rng)
+	time.sleep(1) # Dates have a resolution of one second
+
+def sdFiles(root):
+	# path in the repository: git blob sha
+	found = {}
+	for d, subdirs, names in os.walk(root):
+		for name in names:
+			path = os.path.join(d, name)
+			with open(path, 'rb') as f:
+				data = f.read()
+			found[f'''sd/{os.path.relpath(path, root)}'''] = hashlib.sha1(f'''blob {len(data)}\0'''.encode('ascii') + data).hexdigest()
+	return found
+
+def mirrorFiles(remote):
+	out = subprocess.run(['git', '--git-dir', remote, 'ls-tree', '-r', 'main'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode('utf-8')
+	files = {}
+	for line in out.splitlines():
+		info, path = line.split('\t', 1)
+		files[path] = info.split()[2]
+	return files
+
+def runBackup(args, work, duetServer, githubServer, remote):
+	# Runs one backup - returns exit code, seconds and peak RSS in MB
+	githubUrl = f'''http://127.0.0.1:{githubServer.server_address[1]}'''
+	command = [sys.executable, '-u', args.code, '-userName', 'bench', '-userToken', 'token', '-rep', 'bench',
+		'-duetIP', f'''127.0.0.1:{duetServer.server_address[1]}''', '-githubUrl', githubUrl,
+		'-dir', 'sd/sys', '-dir', 'sd/macros', '-days', '0', '-hours', '0',
+		'-logfile', os.path.join(work, 'duetBackup.log'), '-manifest', os.path.join(work, 'duetBackup.manifest'),
+		'-githubCache', os.path.join(work, 'duetBackup.cache'), '-sdRoot', os.path.join(work, 'not-on-sbc'),
+		'-protocol', args.protocol, '-sink', args.sink]
+	if args.sink == 'mirror':
+		command += ['-mirror', os.path.join(work, 'mirror.git'), '-remote', remote]
+	command += args.extra
+	with open(os.path.join(work, 'output.log'), 'ab') as output:
+		start = time.monotonic()
+		proc = subprocess.Popen(command, stdout=output, stderr=subprocess.STDOUT)
+		pid, status, usage = os.wait4(proc.pid, 0)
+		seconds = time.monotonic() - start
+	proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+	return proc.returncode, seconds, usage.ru_maxrss / 1024 # KB on Linux
+
+def benchmarkSize(args, count, results):
+	rng = random.Random(count) # The same card every time
+	work = tempfile.mkdtemp(prefix=f'''duetBackup-bench-{count}-''')
+	try:
+		sd = os.path.join(work, 'sd')
+		makeSdCard(sd, count, rng)
+		duet = fakeDuet.Duet(sd, args.latency, args.page, args.maxConnections, args.protocol == 'dsf')
+		repo = fakeGithub.Repo('bench', 'bench', truncate = args.truncate)
+		duetServer = fakeDuet.serve(duet)
+		githubServer = fakeGithub.serve(repo, args.githubLatency)
+		remote = os.path.join(work, 'remote.git')
+		if args.sink == 'mirror':
+			subprocess.run(['git', 'init', '--quiet', '--bare', remote], check=True)
+		for state in states:
+			if state == 'incremental':
+				changeSdCard(sd, rng)
+			duet.clearStats()
+			repo.clearStats()
+			code, seconds, rss = runBackup(args, work, duetServer, githubServer, remote)
+			files = mirrorFiles(remote) if args.sink == 'mirror' else repo.files()
+			expected = sdFiles(sd)
+			wrong = sum(1 for path, sha in expected.items() if files.get(path) != sha)
+			wrong += sum(1 for path in files if path.startswith('sd/') and path not in expected)
+			result = {'files': count, 'state': state, 'exit': code, 'seconds': round(seconds, 2), 'rss_mb': round(rss, 1),
+				'printer_calls': dict(duet.calls), 'printer_bytes': duet.bytesOut, 'printer_rejected': duet.rejected,
+				'github_calls': dict(repo.calls), 'github_bytes_in': repo.bytesIn, 'github_bytes_out': repo.bytesOut,
+				'wrong_files': wrong}
+			results.append(result)
+			report(result)
+		duetServer.shutdown()
+		githubServer.shutdown()
+	finally:
+		if args.keep:
+			print(f'''Working directory kept: {work}''')
+		else:
+			shutil.rmtree(work, ignore_errors=True)
+
+def report(result):
+	moved = (result['printer_bytes'] + result['github_bytes_in'] + result['github_bytes_out']) / (1024*1024)
+	print(f'''{result['files']:>7} {result['state']:<12} {result['seconds']:>8.2f}s {result['rss_mb']:>7.1f}MB '''
+		f'''{sum(result['printer_calls'].values()):>7} {sum(result['github_calls'].values()):>7} {moved:>9.2f}MB '''
+		f'''{result['wrong_files']:>6} {result['exit']:>4}''')
+	for source in ['printer_calls', 'github_calls']:
+		for endpoint, calls in sorted(result[source].items()):
+			print(f'''{'':>21}{calls:>7}  {endpoint}''')
+	sys.stdout.flush()
+
+def main():
+	args = init()
+	print(f'''duetBackup benchmark - {args.code}''')
+	print(f'''protocol {args.protocol}, sink {args.sink}, printer latency {args.latency}s, Github latency {args.githubLatency}s, page {args.page}, connections {args.maxConnections}''')
+	print(f'''{'files':>7} {'state':<12} {'time':>9} {'rss':>9} {'printer':>7} {'github':>7} {'moved':>11} {'wrong':>6} {'exit':>4}''')
+	results = []
+	for count in args.sizes:
+		benchmarkSize(args, count, results)
+	if args.json != '':
+		with open(args.json, 'w') as f:
+			json.dump({'settings': {k: v for k, v in vars(args).items() if k != 'json'}, 'results': results}, f, indent=1)
+
+if __name__ == "__main__":
+	main()
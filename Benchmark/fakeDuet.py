@@ -0,0 +1,162 @@
+'''
+Stand-in for a Duet printer serving a local directory as its SD card
+Answers the rr_ requests (standalone) and the DSF HTTP API (SBC) used by duetBackup
+latency - seconds added to every request
+page - entries returned per rr_filelist call
+maxConnections - requests in progress at the same time before 503 is returned, as on a Duet
+Every call is counted per endpoint together with the bytes sent
+Used by benchmark.py - not part of the plugin
+'''
+
+import collections
+import json
+import os
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, unquote
+
+class Duet:
+	def __init__(self, root, latency = 0.0, page = 50, maxConnections = 4, dsf = True, password = 'reprap'):
+		self.root = root
+		self.latency = latency
+		self.page = page
+		self.maxConnections = maxConnections
+		self.dsf = dsf # False - behave like a standalone board
+		self.password = password
+		self.lock = threading.Lock()
+		self.active = 0
+		self.calls = collections.Counter()
+		self.bytesOut = 0
+		self.rejected = 0 # 503 - no more connections
+		self.gcodes = []
+
+	def clearStats(self):
+		self.calls.clear()
+		self.bytesOut = 0
+		self.rejected = 0
+		self.gcodes.clear()
+
+	def localPath(self, name):
+		name = unquote(name)
+		if name.startswith('0:'):
+			name = name[2:]
+		return os.path.join(self.root, name.lstrip('/'))
+
+	def entries(self, folder):
+		# Directory listing in the form both APIs use
+		files = []
+		with os.scandir(folder) as it:
+			for entry in sorted(it, key=lambda e: e.name):
+				st = entry.stat()
+				item = {'type': 'd' if entry.is_dir() else 'f', 'name': entry.name, 'size': 0 if entry.is_dir() else st.st_size,
+					'date': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(st.st_mtime))}
+				files.append(item)
+		return files
+
+def makeHandler(duet):
+	class Handler(BaseHTTPRequestHandler):
+		protocol_version = 'HTTP/1.1'
+		disable_nagle_algorithm = True # Headers and body are written separately - without this keep-alive calls stall on delayed ACKs
+
+		def log_message(self, *args):
+			pass
+
+		def send(self, code, body = b'', contentType = 'application/json'):
+			if isinstance(body, (dict, list)):
+				body = json.dumps(body).encode('utf-8')
+			self.send_response(code)
+			self.send_header('Content-Type', contentType)
+			self.send_header('Content-Length', str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+			duet.bytesOut += len(body)
+
+		def sendFile(self, path):
+			if not os.path.isfile(path):
+				return self.send(404)
+			with open(path, 'rb') as f:
+				return self.send(200, f.read(), 'application/octet-stream')
+
+		def route(self):
+			url = urlparse(self.path)
+			query = {k: v[0] for k, v in parse_qs(url.query).items()}
+			endpoint = url.path
+			if endpoint.startswith('/machine/'):
+				endpoint = '/'.join(endpoint.split('/')[:3]) # Without the file or directory name
+			duet.calls[endpoint] += 1
+			with duet.lock:
+				if duet.active >= duet.maxConnections:
+					duet.rejected += 1
+					return self.send(503, b'No more connections', 'text/plain')
+				duet.active += 1
+			try:
+				time.sleep(duet.latency)
+				if url.path.startswith('/machine/'):
+					if not duet.dsf:
+						return self.send(404)
+					return self.dsfRequest(url.path, query)
+				return self.rrRequest(url.path, query)
+			finally:
+				with duet.lock:
+					duet.active -= 1
+
+		def rrRequest(self, path, query):
+			if path == '/rr_connect':
+				if query.get('password', '') != duet.password:
+					return self.send(200, {'err': 1})
+				return self.send(200, {'err': 0, 'sessionTimeout': 8000, 'boardType': 'bench', 'sessionKey': random.randint(1, 1 << 30), 'apiLevel': 1})
+			if path == '/rr_disconnect':
+				return self.send(200, {'err': 0})
+			if path == '/rr_gcode':
+				duet.gcodes.append(query.get('gcode', ''))
+				return self.send(200, {'buff': 255})
+			if path == '/rr_filelist':
+				folder = duet.localPath(query.get('dir', '0:/'))
+				if not os.path.isdir(folder):
+					return self.send(200, {'err': 2})
+				files = duet.entries(folder)
+				first = int(query.get('first', 0))
+				more = first + duet.page < len(files)
+				return self.send(200, {'dir': query.get('dir'), 'first': first, 'files': files[first:first + duet.page], 'next': first + duet.page if more else 0, 'err': 0})
+			if path == '/rr_download':
+				return self.sendFile(duet.localPath(query.get('name', '')))
+			return self.send(404)
+
+		def dsfRequest(self, path, query):
+			if path == '/machine/connect':
+				if query.get('password', '') != duet.password:
+					return self.send(403)
+				return self.send(200, {'sessionKey': random.randint(1, 1 << 30), 'sessionTimeout': 8000})
+			if path == '/machine/disconnect':
+				return self.send(204)
+			if 'X-Session-Key' not in self.headers:
+				return self.send(403)
+			if path == '/machine/code':
+				length = int(self.headers.get('Content-Length') or 0)
+				duet.gcodes.append(self.rfile.read(length).decode('utf-8'))
+				return self.send(200, b'', 'text/plain')
+			if path.startswith('/machine/directory/'):
+				folder = duet.localPath(path[len('/machine/directory/'):])
+				if not os.path.isdir(folder):
+					return self.send(404)
+				return self.send(200, duet.entries(folder))
+			if path.startswith('/machine/file/'):
+				return self.sendFile(duet.localPath(path[len('/machine/file/'):]))
+			return self.send(404)
+
+		def do_GET(self):
+			self.route()
+
+		def do_POST(self):
+			self.route()
+
+	return Handler
+
+def serve(duet):
+	# Returns the server - the printer address is 127.0.0.1:<server.server_address[1]>
+	server = ThreadingHTTPServer(('127.0.0.1', 0), makeHandler(duet))
+	server.daemon_threads = True
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	return server
@@ -0,0 +1,285 @@
+'''
+Stand-in for the parts of the Github REST / Git Data API and the Git LFS batch API used by duetBackup
+Objects are kept in memory and hashed the same way as git so that blob shas match
+Every call is counted per endpoint together with the bytes received and sent
+Used by benchmark.py - not part of the plugin
+'''
+
+import base64
+import collections
+import hashlib
+import json
+import re
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+shaPattern = re.compile(r'[0-9a-f]{40}')
+
+class Repo:
+	# One repository with one branch - starts with an empty commit like a new repository with no files
+	def __init__(self, owner, name, branch = 'main', truncate = 100000, rateLimit = 5000):
+		self.owner = owner
+		self.name = name
+		self.branch = branch
+		self.truncate = truncate # Entries in a recursive tree before it is reported as truncated
+		self.rateLimit = rateLimit
+		self.remaining = rateLimit
+		self.reset = int(time.time()) + 3600
+		self.objects = {} # sha: (type, payload) - blob: bytes, tree: [(mode, name, sha, type)], commit: dict
+		self.lfs = {} # oid: size
+		self.refs = {}
+		self.lock = threading.Lock()
+		self.calls = collections.Counter()
+		self.bytesIn = 0
+		self.bytesOut = 0
+		self.refs[branch] = self.writeCommit(self.writeTree({}), [], 'Initial commit')
+
+	def clearStats(self):
+		self.calls.clear()
+		self.bytesIn = 0
+		self.bytesOut = 0
+
+	def put(self, kind, raw, payload):
+		sha = hashlib.sha1(f'''{kind} {len(raw)}\0'''.encode('ascii') + raw).hexdigest()
+		self.objects[sha] = (kind, payload)
+		return sha
+
+	def writeBlob(self, data):
+		return self.put('blob', data, data)
+
+	def writeTree(self, nested):
+		# nested is {name: blob sha or {nested}}
+		entries = []
+		for name, value in nested.items():
+			if isinstance(value, dict):
+				entries.append(('40000', name, self.writeTree(value), 'tree'))
+			else:
+				entries.append(('100644', name, value, 'blob'))
+		entries.sort(key=lambda e: e[1] + ('/' if e[3] == 'tree' else '')) # git tree order
+		raw = b''.join(f'''{m} {n}\0'''.encode('utf-8') + bytes.fromhex(s) for m, n, s, t in entries)
+		return self.put('tree', raw, entries)
+
+	def writeCommit(self, tree, parents, message):
+		date = int(time.time())
+		raw = f'''tree {tree}\n''' + ''.join(f'''parent {p}\n''' for p in parents)
+		raw += f'''author bench <bench@example.com> {date} +0000\ncommitter bench <bench@example.com> {date} +0000\n\n{message}'''
+		return self.put('commit', raw.encode('utf-8'), {'tree': tree, 'parents': parents, 'message': message, 'date': date})
+
+	def nested(self, treeSha):
+		return {n: self.nested(s) if t == 'tree' else s for m, n, s, t in self.objects[treeSha][1]}
+
+	def flat(self, treeSha, prefix = ''):
+		# (mode, path, sha, type, size) for everything below the tree
+		for m, n, s, t in self.objects[treeSha][1]:
+			if t == 'tree':
+				yield ('040000', f'''{prefix}{n}''', s, t, None)
+				yield from self.flat(s, f'''{prefix}{n}/''')
+			else:
+				yield (m, f'''{prefix}{n}''', s, t, len(self.objects[s][1]))
+
+	def files(self):
+		# path: blob sha at the head of the branch
+		tree = self.objects[self.refs[self.branch]][1]['tree']
+		return {p: s for m, p, s, t, z in self.flat(tree) if t == 'blob'}
+
+def isoDate(seconds):
+	return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(seconds))
+
+def makeHandler(repo, latency):
+	base = f'''/repos/{repo.owner}/{repo.name}'''
+
+	class Handler(BaseHTTPRequestHandler):
+		protocol_version = 'HTTP/1.1' # keep-alive like Github
+		disable_nagle_algorithm = True # Headers and body are written separately - without this keep-alive calls stall on delayed ACKs
+
+		def log_message(self, *args):
+			pass
+
+		def host(self):
+			return f'''http://{self.headers['Host']}'''
+
+		def send(self, code, obj = None, headers = None):
+			body = b'' if obj is None else json.dumps(obj).encode('utf-8')
+			etag = None
+			if self.command == 'GET' and code == 200:
+				etag = f'''"{hashlib.sha1(body).hexdigest()}"'''
+				if self.headers.get('If-None-Match') == etag:
+					code, body = 304, b''
+			if code not in [304, 403]: # Conditional requests that match are free
+				repo.remaining = max(0, repo.remaining - 1)
+			self.send_response(code)
+			self.send_header('Content-Type', 'application/json')
+			self.send_header('Content-Length', str(len(body)))
+			if etag is not None:
+				self.send_header('ETag', etag)
+			self.send_header('X-RateLimit-Limit', str(repo.rateLimit))
+			self.send_header('X-RateLimit-Remaining', str(repo.remaining))
+			self.send_header('X-RateLimit-Reset', str(repo.reset))
+			for key, value in (headers or {}).items():
+				self.send_header(key, value)
+			self.end_headers()
+			self.wfile.write(body)
+			repo.bytesOut += len(body)
+
+		def body(self):
+			if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+				data = bytearray()
+				while True:
+					size = int(self.rfile.readline().strip(), 16)
+					if size == 0:
+						self.rfile.readline()
+						break
+					data += self.rfile.read(size)
+					self.rfile.readline()
+				data = bytes(data)
+			else:
+				data = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+			repo.bytesIn += len(data)
+			return data
+
+		def commitJson(self, sha):
+			c = repo.objects[sha][1]
+			person = {'name': 'bench', 'email': 'bench@example.com', 'date': isoDate(c['date'])}
+			return {'sha': sha, 'url': f'''{self.host()}{base}/git/commits/{sha}''', 'message': c['message'],
+				'tree': {'sha': c['tree'], 'url': f'''{self.host()}{base}/git/trees/{c['tree']}'''},
+				'parents': [{'sha': p, 'url': f'''{self.host()}{base}/git/commits/{p}'''} for p in c['parents']],
+				'author': person, 'committer': person}
+
+		def treeJson(self, sha, items, truncated):
+			tree = []
+			for mode, path, s, t, size in items:
+				entry = {'path': path, 'mode': mode, 'type': t, 'sha': s, 'url': f'''{self.host()}{base}/git/{t}s/{s}'''}
+				if size is not None:
+					entry['size'] = size
+				tree.append(entry)
+			return {'sha': sha, 'url': f'''{self.host()}{base}/git/trees/{sha}''', 'truncated': truncated, 'tree': tree}
+
+		def refJson(self, branch):
+			sha = repo.refs[branch]
+			return {'ref': f'''refs/heads/{branch}''', 'url': f'''{self.host()}{base}/git/refs/heads/{branch}''',
+				'object': {'sha': sha, 'type': 'commit', 'url': f'''{self.host()}{base}/git/commits/{sha}'''}}
+
+		def route(self, method):
+			time.sleep(latency)
+			url = urlparse(self.path)
+			path = url.path
+			query = parse_qs(url.query)
+			endpoint = shaPattern.sub('{sha}', f'''{method} {path.replace(base, '{repo}', 1)}''')
+			repo.calls[endpoint] += 1
+			data = self.body() if method in ['POST', 'PATCH', 'PUT'] else b''
+			with repo.lock:
+				if '/info/lfs/' in path:
+					return self.lfs(method, path, data)
+				if time.time() >= repo.reset:
+					repo.remaining = repo.rateLimit
+					repo.reset = int(time.time()) + 3600
+				if repo.remaining == 0:
+					return self.send(403, {'message': 'API rate limit exceeded'})
+				return self.api(method, path, query, data)
+
+		def lfs(self, method, path, data):
+			if path.endswith('/objects/batch'):
+				objects = []
+				for obj in json.loads(data)['objects']:
+					if obj['oid'] in repo.lfs:
+						objects.append(obj)
+					else:
+						href = f'''{self.host()}{base}.git/info/lfs/upload/{obj['oid']}'''
+						objects.append(dict(obj, actions={'upload': {'href': href}}))
+				return self.send(200, {'transfer': 'basic', 'objects': objects})
+			if '/upload/' in path and method == 'PUT':
+				repo.lfs[path.split('/')[-1]] = len(data)
+				return self.send(200)
+			return self.send(404, {'message': 'Not Found'})
+
+		def api(self, method, path, query, data):
+			m = re.fullmatch(f'''{base}/git/refs?/heads/(.+)''', path)
+			if m:
+				branch = m.group(1)
+				if branch not in repo.refs:
+					return self.send(404, {'message': 'Not Found'})
+				if method == 'PATCH':
+					repo.refs[branch] = json.loads(data)['sha']
+				return self.send(200, self.refJson(branch))
+			m = re.fullmatch(f'''{base}/branches/(.+)''', path)
+			if m:
+				branch = m.group(1)
+				if branch not in repo.refs:
+					return self.send(404, {'message': 'Branch not found'})
+				sha = repo.refs[branch]
+				return self.send(200, {'name': branch, 'commit': {'sha': sha, 'url': f'''{self.host()}{base}/commits/{sha}''', 'commit': self.commitJson(sha)}})
+			m = re.fullmatch(f'''{base}/git/commits/([0-9a-f]{{40}})''', path)
+			if m and m.group(1) in repo.objects:
+				return self.send(200, self.commitJson(m.group(1)))
+			m = re.fullmatch(f'''{base}/git/trees/([0-9a-f]{{40}})''', path)
+			if m and m.group(1) in repo.objects:
+				sha = m.group(1)
+				if query.get('recursive'):
+					items = list(repo.flat(sha))
+				else:
+					items = [('040000' if t == 'tree' else mode, n, s, t, len(repo.objects[s][1]) if t == 'blob' else None) for mode, n, s, t in repo.objects[sha][1]]
+				truncated = bool(query.get('recursive')) and len(items) > repo.truncate
+				if truncated:
+					items = items[:repo.truncate]
+				return self.send(200, self.treeJson(sha, items, truncated))
+			if method == 'POST' and path == f'''{base}/git/blobs''':
+				request = json.loads(data)
+				content = request['content']
+				blob = base64.b64decode(content) if request.get('encoding') == 'base64' else content.encode('utf-8')
+				sha = repo.writeBlob(blob)
+				return self.send(201, {'sha': sha, 'url': f'''{self.host()}{base}/git/blobs/{sha}'''})
+			if method == 'POST' and path == f'''{base}/git/trees''':
+				return self.createTree(json.loads(data))
+			if method == 'POST' and path == f'''{base}/git/commits''':
+				request = json.loads(data)
+				sha = repo.writeCommit(request['tree'], request.get('parents', []), request['message'])
+				return self.send(201, self.commitJson(sha))
+			return self.send(404, {'message': 'Not Found'})
+
+		def createTree(self, request):
+			nested = repo.nested(request['base_tree']) if request.get('base_tree') else {}
+			for element in request['tree']:
+				parts = element['path'].split('/')
+				folder = nested
+				for part in parts[:-1]:
+					folder = folder.setdefault(part, {})
+				if 'content' in element:
+					folder[parts[-1]] = repo.writeBlob(element['content'].encode('utf-8'))
+				elif element.get('sha') is None:
+					folder.pop(parts[-1], None) # Deleted
+				else:
+					folder[parts[-1]] = element['sha']
+
+			def prune(folder): # git has no empty directories
+				for name in list(folder):
+					if isinstance(folder[name], dict):
+						prune(folder[name])
+						if not folder[name]:
+							del folder[name]
+			prune(nested)
+			sha = repo.writeTree(nested)
+			items = [('040000' if t == 'tree' else mode, n, s, t, None) for mode, n, s, t in repo.objects[sha][1]]
+			return self.send(201, self.treeJson(sha, items, False))
+
+		def do_GET(self):
+			self.route('GET')
+
+		def do_POST(self):
+			self.route('POST')
+
+		def do_PATCH(self):
+			self.route('PATCH')
+
+		def do_PUT(self):
+			self.route('PUT')
+
+	return Handler
+
+def serve(repo, latency = 0.0):
+	# Returns the server - the base url is http://127.0.0.1:<server.server_address[1]>
+	server = ThreadingHTTPServer(('127.0.0.1', 0), makeHandler(repo, latency))
+	server.daemon_threads = True
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	return server
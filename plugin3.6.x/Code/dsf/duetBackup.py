@@ -11,22 +11,39 @@ Venv python install e.g.
 import argparse
 import shlex
 import sys
-from github import Github
+from github import Github, GithubException, InputGitTreeElement, RateLimitExceededException
+from github.Repository import Repository
 import os
 import re
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
 import time
+import random
 import requests
+import requests.adapters
+from urllib.parse import quote, urlsplit
+from contextlib import contextmanager
 import json
 import signal
 import hashlib
-from fnmatch import fnmatch
+import base64
+import io
+import tempfile
+import subprocess
+import threading
+import ctypes
+import ctypes.util
+import select
+import cProfile
+import struct
+from concurrent.futures import ThreadPoolExecutor
+import queue
 import logging
 from pathlib import Path
 
 global progName, progVersion
 progName = 'duetBackup'
-progVersion = "2.0"
+progVersion = "2.1"
 # Min python version
 pythonMajor = 3
 pythonMinor = 8
@@ -71,6 +88,33 @@ pythonMinor = 8
 - force the defult sd folder names to lower case
 - tolerates incorrect case in the default sd folder names 
 - removed .gitignore file (redundant)
+
+# Version 2.1
+- each backup is a single commit made with the Git Data API
+- repository files are listed with a single recursive tree call
+- unchanged files are detected without any Github calls
+- one printer session is kept open instead of reconnecting for each request
+- printer calls use pooled keep-alive connections and back off between retries
+- files are downloaded from the printer in parallel (-downloadWorkers)
+- listing, downloading and uploading overlap as a streaming pipeline
+- large directories are listed page by page
+- files with unchanged size and date are not downloaded (-manifest, -fullScan)
+- file content is handled as bytes - binary and non-ASCII files hash correctly
+- files are streamed in chunks so memory use does not depend on file size
+- files over -maxFileSize are skipped before download or stored with Git LFS (-lfs)
+- -ignore uses .gitignore rules and ignored directories are not listed
+- printer and repository files are compared with dictionary lookups - deletes are found in one pass
+- README.md is built in one pass, a JSON summary is written to backup.json, -readmeOnChange
+- Github calls go through a rate limit scheduler - calls are paced or paused near the limit
+- Github reads are conditional (ETag) and cached on disk between runs (-githubCache)
+- one Github client for the life of the program - last backup time from the branch head ref
+- -watch uses inotify to back up only changed files, in one commit, as they are written (-watchDelay, -sdRoot)
+- on the SBC files are read directly from -sdRoot (os.scandir walk, hashed in place, copied only to upload)
+- printer access is behind PrinterSession - DsfSession implements the DSF HTTP API and -protocol auto probes for it
+- -sink mirror commits to a local bare mirror with the git CLI (hash-object, temporary index, commit-tree) and pushes once
+- -githubUrl sets the Github API url (Github Enterprise, Benchmark/ stand-in servers)
+- phase times, file counts and printer, Github and git call statistics are written after each backup as a Prometheus textfile and JSON (-metrics)
+- -trace writes a timeline of each backup (phases, files and calls) in Chrome trace-event format, -profile adds a cProfile dump
 ''' 
 
 def setuplogging():  #Called at start
@@ -110,6 +154,8 @@ def setupLogfile():
 	logger.addHandler(f_handler)
 
 def logMessage(level,msg,error,space=False):
+	if level in ['error', 'critical']:
+		metrics.count('log_errors')
 	if space:
 		msg = f'''\n{msg}'''
 		if error != '':
@@ -147,34 +193,280 @@ def logMessage(level,msg,error,space=False):
 
 def sendDuetGcode(command):
 	# send a gcode command to Duet
-	if reconnectPrinter() :
-		command = f'''/rr_gcode?gcode={command}'''  #Post includes command type in url
-		urlCall(printerUrl, command, False) # Post form - sent blindly
+	printer.gcode(command) # sent blindly
+
+class Metrics:
+	# Counters and timers for one backup cycle - cleared at the start of each cycle
+	# Written after each cycle as a Prometheus textfile and a JSON snapshot (-metrics)
+	# Phases that run in parallel threads (download, hash, upload) are totals across the threads
+	latencyBuckets = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30] # seconds
+	shaPattern = re.compile(r'[0-9a-f]{40}')
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.reset()
+
+	def reset(self):
+		with self.lock:
+			self.started = time.time()
+			self.phases = {} # name: [seconds, count]
+			self.counters = {} # name: value
+			self.http = {} # (service, endpoint): {calls, codes, seconds, buckets, sent, received, retries}
+
+	@contextmanager
+	def phase(self, name, detail = None):
+		# detail (e.g. the file) names the span in the -trace timeline
+		start = time.monotonic()
+		try:
+			yield
+		finally:
+			end = time.monotonic()
+			self.addTime(name, end - start)
+			trace.span(detail or name, name, start, end)
+
+	def addTime(self, name, seconds, count = 1):
+		with self.lock:
+			phase = self.phases.setdefault(name, [0.0, 0])
+			phase[0] += seconds
+			phase[1] += count
+
+	def count(self, name, value = 1):
+		with self.lock:
+			self.counters[name] = self.counters.get(name, 0) + value
+
+	def set(self, name, value):
+		with self.lock:
+			self.counters[name] = value
+
+	def endpoint(self, method, url):
+		# e.g. GET {repo}/git/trees/{sha} - one entry per kind of call, not per file
+		path = urlsplit(url).path
+		path = path.replace(f'''/repos/{userName}/{userRepo}''', '{repo}', 1)
+		return f'''{method} {self.shaPattern.sub('{sha}', path)}'''
+
+	def request(self, service, endpoint, seconds, code, sent = 0, received = 0, retry = False):
+		end = time.monotonic()
+		trace.span(endpoint, service, end - seconds, end, {'code': code, 'sent': sent, 'received': received, 'retry': retry})
+		with self.lock:
+			stats = self.http.get((service, endpoint))
+			if stats is None:
+				stats = {'calls': 0, 'codes': {}, 'seconds': 0.0, 'buckets': [0]*len(self.latencyBuckets), 'sent': 0, 'received': 0, 'retries': 0}
+				self.http[(service, endpoint)] = stats
+			stats['calls'] += 1
+			stats['codes'][str(code)] = stats['codes'].get(str(code), 0) + 1
+			stats['seconds'] += seconds
+			for i, limit in enumerate(self.latencyBuckets):
+				if seconds <= limit:
+					stats['buckets'][i] += 1
+			stats['sent'] += sent
+			stats['received'] += received
+			if retry:
+				stats['retries'] += 1
+
+	def setFiles(self, diff):
+		for name, files in (('source', diff.source), ('added', diff.added), ('updated', diff.updated), ('deleted', diff.deleted), ('protected', diff.protected), ('errors', diff.errors)):
+			self.set(f'''files_{name}''', len(files))
+
+	def snapshot(self, success):
+		with self.lock:
+			wait = self.phases.get('wait', [0.0, 0])[0]
+			return {
+				'version': progVersion,
+				'printer': duetIP,
+				'repository': f'''{userName}/{userRepo}''',
+				'branch': main,
+				'started': self.started,
+				'finished': time.time(),
+				'duration_seconds': round(time.time() - self.started - wait, 3), # Not counting the wait for the backup to be due
+				'success': success,
+				'phases': {name: {'seconds': round(v[0], 3), 'count': v[1]} for name, v in self.phases.items()},
+				'counters': dict(self.counters),
+				'http': [dict(stats, service=service, endpoint=endpoint, seconds=round(stats['seconds'], 3), codes=dict(stats['codes']), buckets=dict(zip([str(x) for x in self.latencyBuckets], stats['buckets'])))
+					for (service, endpoint), stats in sorted(self.http.items())]
+				}
+
+	def prometheus(self, snap):
+		def label(value):
+			return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+		lines = []
+		def metric(name, help, type, samples):
+			lines.append(f'''# HELP duetbackup_{name} {help}''')
+			lines.append(f'''# TYPE duetbackup_{name} {type}''')
+			for labels, value in samples:
+				text = ','.join(f'''{k}="{label(v)}"''' for k, v in labels.items())
+				if text != '':
+					text = f'''{{{text}}}'''
+				lines.append(f'''duetbackup_{name}{text} {value}''')
+
+		metric('info', 'duetBackup version and what is backed up', 'gauge',
+			[({'version': snap['version'], 'printer': snap['printer'], 'repository': snap['repository'], 'branch': snap['branch']}, 1)])
+		metric('last_backup_timestamp_seconds', 'When the last backup finished', 'gauge', [({}, round(snap['finished'], 3))])
+		metric('backup_duration_seconds', 'Length of the last backup', 'gauge', [({}, snap['duration_seconds'])])
+		metric('backup_success', '1 if the last backup was committed', 'gauge', [({}, 1 if snap['success'] else 0)])
+		metric('phase_seconds', 'Time spent in each phase of the last backup', 'gauge', [({'phase': k}, v['seconds']) for k, v in sorted(snap['phases'].items())])
+		metric('phase_count', 'Times each phase ran in the last backup', 'gauge', [({'phase': k}, v['count']) for k, v in sorted(snap['phases'].items())])
+		for name, value in sorted(snap['counters'].items()):
+			metric(name, f'''{name.replace('_', ' ')} in the last backup''', 'gauge', [({}, value)])
+		http = snap['http']
+		metric('http_requests', 'HTTP requests in the last backup', 'gauge',
+			[({'service': h['service'], 'endpoint': h['endpoint'], 'code': code}, n) for h in http for code, n in sorted(h['codes'].items())])
+		metric('http_retries', 'HTTP requests that were retries', 'gauge', [({'service': h['service'], 'endpoint': h['endpoint']}, h['retries']) for h in http])
+		metric('http_bytes', 'HTTP bytes sent and received', 'gauge',
+			[({'service': h['service'], 'endpoint': h['endpoint'], 'direction': d}, h[d]) for h in http for d in ['sent', 'received']])
+		lines.append('''# HELP duetbackup_http_request_seconds HTTP request latency in the last backup''')
+		lines.append('''# TYPE duetbackup_http_request_seconds histogram''')
+		for h in http:
+			labels = f'''service="{label(h['service'])}",endpoint="{label(h['endpoint'])}"'''
+			for le, n in h['buckets'].items():
+				lines.append(f'''duetbackup_http_request_seconds_bucket{{{labels},le="{le}"}} {n}''')
+			lines.append(f'''duetbackup_http_request_seconds_bucket{{{labels},le="+Inf"}} {h['calls']}''')
+			lines.append(f'''duetbackup_http_request_seconds_sum{{{labels}}} {h['seconds']}''')
+			lines.append(f'''duetbackup_http_request_seconds_count{{{labels}}} {h['calls']}''')
+		return '\n'.join(lines) + '\n'
+
+	def write(self, success):
+		# Both files are replaced in one step so a reader never sees a partly written file
+		if metricsfilename == '':
+			return
+		snap = self.snapshot(success)
+		jsonname = f'''{os.path.splitext(metricsfilename)[0]}.json'''
+		try:
+			for name, text in ((metricsfilename, self.prometheus(snap)), (jsonname, json.dumps(snap, indent=1))):
+				tempname = f'''{name}.tmp'''
+				with open(tempname, 'w', encoding='utf-8') as f:
+					f.write(text)
+				os.replace(tempname, name)
+		except Exception as e:
+			msg = f'''Could not write metrics {metricsfilename}'''
+			logMessage('info',msg,str(e),True)
 
-def urlCall(url, cmd, post):
+metrics = Metrics()
+
+class Trace:
+	# Timeline of one backup cycle in Chrome trace-event format (-trace) - open it in chrome://tracing or ui.perfetto.dev
+	# Spans come from the metrics - each phase, each file downloaded or uploaded, and the calls made inside them
+	# -profile also writes a cProfile dump of the cycle (main thread) next to the trace
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.events = []
+		self.threads = {} # thread id: name
+		self.origin = time.monotonic()
+		self.profiler = None
+
+	def reset(self):
+		if tracefilename == '':
+			return
+		with self.lock:
+			self.events = []
+			self.threads = {}
+			self.origin = time.monotonic()
+		if profile:
+			if self.profiler is not None:
+				self.profiler.disable()
+			self.profiler = cProfile.Profile()
+			self.profiler.enable()
+
+	def span(self, name, category, start, end, args = None):
+		if tracefilename == '':
+			return
+		thread = threading.current_thread()
+		event = {'name': name, 'cat': category, 'ph': 'X', 'pid': os.getpid(), 'tid': thread.ident,
+			'ts': round((start - self.origin)*1000000), 'dur': round((end - start)*1000000)}
+		if args:
+			event['args'] = args
+		with self.lock:
+			self.threads[thread.ident] = thread.name
+			self.events.append(event)
+
+	def write(self):
+		# Replaced after each cycle - the profile is written first so that it does not profile the write
+		if tracefilename == '':
+			return
+		profilename = f'''{os.path.splitext(tracefilename)[0]}.prof'''
+		try:
+			if self.profiler is not None:
+				self.profiler.disable()
+				self.profiler.dump_stats(profilename)
+				self.profiler = None
+			with self.lock:
+				names = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': name}} for tid, name in self.threads.items()]
+				events = names + self.events
+			tempname = f'''{tracefilename}.tmp'''
+			with open(tempname, 'w', encoding='utf-8') as f:
+				json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+			os.replace(tempname, tracefilename)
+			logger.debug(f'''Trace with {len(events)} events written to {tracefilename}''')
+		except Exception as e:
+			msg = f'''Could not write trace {tracefilename}'''
+			logMessage('info',msg,str(e),True)
+
+trace = Trace()
+
+httpSessions = {} # One pooled keep-alive session per endpoint
+incompleteDirs = [] # Directories that could not be fully listed this run
+retryCodes = [408,429,500,502,503,504] # Transient - worth trying again
+chunkSize = 64*1024 # Files are downloaded, hashed and uploaded in chunks of this size
+spoolMemoryLimit = 1024*1024 # Larger files are spooled to a temporary file
+githubTimeout = 60 # seconds - large blob uploads
+
+def getHttpSession(url):
+	endpoint = '/'.join(url.split('/')[:3]) # scheme://host:port
+	session = httpSessions.get(endpoint)
+	if session is None:
+		session = requests.Session()
+		adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(10, downloadWorkers))
+		session.mount('http://', adapter)
+		session.mount('https://', adapter)
+		httpSessions[endpoint] = session
+	return session
+
+def retryDelay(attempt, r):
+	# Honour Retry-After if the server sent one, otherwise exponential backoff with jitter
+	if r is not None:
+		after = r.headers.get('Retry-After')
+		if after:
+			try:
+				return min(float(after), 300)
+			except ValueError:
+				try:
+					wait = (parsedate_to_datetime(after) - datetime.now(timezone.utc)).total_seconds()
+					return min(max(wait, 0), 300)
+				except Exception:
+					pass
+	return random.uniform(0, min(30, 0.5 * 2**attempt))
+
+def urlCall(url, cmd, post, headers = None, timeout = None, retryOn = None, stream = False):
 	# Makes all the calls to the printer
 	# If post is True then make a http post call
 	# Get commands need a leading /
-	# Set defaults for return codes
-	code = 0
-	error = 'Unknown'
-
-	timelimit = 5  # timout for call to return
+	# Returns code, payload - code is 0 if no response was received
+	# If stream is True the payload is the open response - the caller reads and closes it
+	if timeout is None:
+		timeout = httpTimeout  # timout for call to return
+	if retryOn is None:
+		retryOn = retryCodes
+	session = getHttpSession(url)
 	loop = 0
-	limit = 2  # seems good enough to catch transients
-	r = ''
+	r = None
 	if post is False:
 		url = url + cmd  # concatenate for GET
-	while loop < limit:
+	endpoint = urlsplit(url).path
+	if endpoint.startswith('/machine/'):
+		endpoint = '/'.join(endpoint.split('/')[:3]) # Not the file or directory name
+	endpoint = f'''{'POST' if post else 'GET'} {endpoint}'''
+	while True:
+		r = None
+		start = time.monotonic()
 		try:
 			if post is False:
 				msg = f'''Connection attempt: {loop} url: {url} post:{post}'''
 				logMessage('debug',msg,'',True)
-				r = requests.get(url, timeout=timelimit) # if using rr_ API
+				r = session.get(url, timeout=timeout, headers=headers, stream=stream) # if using rr_ API
 			else: #post includes the http command type in the url
 				msg = f'''Connection attempt {loop} url: {url} cmd: {cmd} post:{post}'''
 				logMessage('debug',msg,'',True)
-				r = requests.post(url, timeout=timelimit, data=cmd) # If using rr_ API
+				r = session.post(url, timeout=timeout, data=cmd, headers=headers) # If using rr_ API
 
 		except requests.ConnectionError as e:
 			msg = 'Cannot connect to the printer - likely a network error'
@@ -182,40 +474,292 @@ def urlCall(url, cmd, post):
 		except requests.exceptions.Timeout as e:
 			msg = 'Timed out - Is the printer turned on?'
 			logMessage('info',msg,'',True)
-		finally:
-			if r.status_code in [200,204]: #204 is no content e.g. disconnect
-				return r.status_code, r.text
+		received = 0
+		if r is not None: # The body of a streamed download is read later - use the length it was sent with
+			received = int(r.headers.get('Content-Length') or 0) if stream else len(r.content)
+		metrics.request('printer', endpoint, time.monotonic() - start, 0 if r is None else r.status_code,
+			len(cmd) if post else 0, received, loop > 0)
+
+		if r is not None and r.status_code not in retryOn:
+			break # Success or an error that will not go away by retrying
+		if loop >= httpRetries:
+			break
+		delay = retryDelay(loop, r)
+		if r is not None and stream:
+			r.close() # Give the connection back to the pool before trying again
+		logger.debug(f'''Retrying in {delay:.1f} seconds''')
+		time.sleep(delay)
+		loop += 1 # Loop back and try again
+
+	if r is None:
+		return 0, None if stream else ''
+	if r.status_code not in [200,204]: #204 is no content e.g. disconnect
+		msg = f'''Error - code = {r.status_code} payload = {r.text}'''
+		logMessage('debug',msg,'',True)
+
+	return r.status_code, r if stream else r.text
+
+class ConnectionLimit:
+	# Adaptive limit on concurrent printer requests
+	# Halved when the printer has no more connections (503) and raised by one after a run of successes
+	def __init__(self, maximum):
+		self.maximum = max(1, maximum)
+		self.limit = self.maximum
+		self.active = 0
+		self.successes = 0
+		self.cond = threading.Condition()
+
+	def acquire(self):
+		with self.cond:
+			while self.active >= self.limit:
+				self.cond.wait()
+			self.active += 1
+
+	def release(self, busy):
+		with self.cond:
+			self.active -= 1
+			if busy:
+				self.successes = 0
+				if self.limit > 1:
+					self.limit = max(1, self.limit // 2)
+					logger.debug(f'''Printer is busy - reducing concurrent requests to {self.limit}''')
 			else:
-				time.sleep(1)
-				loop += 1 # Loop back and try again
-	
-	msg = f'''Error - code = {r.status_code} payload = {r.text}'''
-	logMessage('debug',msg,'',True)
+				self.successes += 1
+				if self.limit < self.maximum and self.successes >= self.limit * 4:
+					self.successes = 0
+					self.limit += 1
+					logger.debug(f'''Increasing concurrent requests to {self.limit}''')
+			self.cond.notify_all()
+
+class PrinterSession:
+	# Holds one rr_ session open for all calls to the printer
+	# rr_connect is only repeated if the session has expired or been rejected
+	# The rr_ protocol works with standalone and SBC printers - see DsfSession for the SBC API
+	protocol = 'rr_'
+
+	def __init__(self, url, password, workers = 1):
+		self.url = url
+		self.password = password
+		self.sessionKey = None
+		self.sessionTimeout = 8.0 # seconds - updated from the rr_connect reply
+		self.connected = False
+		self.lastUsed = 0
+		self.logins = 0 # Counts successful connects - a thread can tell if another has already logged in again
+		self.lock = threading.Lock() # Only one thread logs in at a time
+		self.slots = ConnectionLimit(workers)
+
+	def headers(self):
+		if self.sessionKey is None:
+			return None
+		return {'X-Session-Key': str(self.sessionKey)}
+
+	def expired(self):
+		# The printer drops sessions that have been idle for longer than sessionTimeout
+		return time.time() - self.lastUsed >= self.sessionTimeout
+
+	def connectCommand(self):
+		return f'''/rr_connect?sessionKey=yes&password={self.password}'''
+
+	def disconnectCommand(self):
+		return '/rr_disconnect'
+
+	def downloadCommand(self, file):
+		return f'''/rr_download?name={file}'''
+
+	def gcode(self, command):
+		return self.request(f'''/rr_gcode?gcode={command}''')
+
+	def listDir(self, dir):
+		# Generator for the entries in dir
+		# Large directories are returned in pages - follow the next cursor until it is 0
+		first = 0
+		pages = 0
+		while True:
+			command = f'''/rr_filelist?first={first}&dir={dir}'''
+			code, payload = self.request(command) # Get form
+			if code != 200:
+				incompleteDirs.append(dir)
+				return
+			status = 0
+			try:
+				j = json.loads(payload)
+				status = j['err']
+			except Exception as e:
+				msg = f'''Unknown error getting files from {dir}'''
+				logMessage('info',msg,str(e),True)
+				incompleteDirs.append(dir)
+				return
+			if status == 1: # Drive does not exist
+				msg = f'''Drive {dir} does not exist'''
+				logMessage('info',msg,'',False)
+				return
+			elif status == 2: # Directory  does not exist
+				msg = f'''Directory {dir} does not exist'''
+				logMessage('info',msg,'',False)
+				return
+			elif status != 0:
+				msg = f'''Error {status} getting files from {dir}'''
+				logMessage('info',msg,'',False)
+				incompleteDirs.append(dir)
+				return
+			pages += 1
+			yield from j['files']
+			nextFirst = j.get('next', 0)
+			if nextFirst == 0 or nextFirst <= first: #complete list
+				break
+			first = nextFirst
+		logger.debug(f'''{dir} listed in {pages} page(s)''')
+
+	def connect(self): #logon and get key parameters
+		with metrics.phase('connect'): # Shows up in -trace if the printer keeps dropping the session
+			code, payload = urlCall(self.url, self.connectCommand(), False)
+		if code in [200,204]:
+			try:
+				j = json.loads(payload)
+				status = j.get('err', 0)
+			except Exception:
+				j = {}
+				status = 0
+			if status == 0:
+				self.sessionKey = j.get('sessionKey')
+				if j.get('sessionTimeout'):
+					self.sessionTimeout = j['sessionTimeout']/1000
+				self.connected = True
+				self.lastUsed = time.time()
+				self.logins += 1
+				logger.debug(f'''Connected to printer - session timeout {self.sessionTimeout:.0f} seconds''')
+				return True
+			code = 403 if status == 1 else 503 # rr_connect reports errors in the payload
+		if code == 403:
+			msg = 'Password is invalid'
+		elif code == 503:
+			msg = 'No more connections available'
+		elif code == 502:
+			msg = 'Incorrect DCS version'
+		else:
+			msg = f'''Is the Printer turned on?.'''
+		
+		self.connected = False
+		msg = f'''Login issue: {msg} code = {code}'''
+		logMessage('info',msg,'',True)
+		return False
+
+	def disconnect(self):
+		if self.connected:
+			urlCall(self.url, self.disconnectCommand(), False, self.headers()) #Called blindly - does not return anything
+		self.connected = False
+		self.sessionKey = None
+
+	def request(self, cmd, consume = None, data = None):
+		# Get form - returns code, payload
+		# If consume is given the response is streamed to consume(response) - payload is what it returns
+		# If data is given it is posted to cmd
+		with self.lock:
+			if not self.connected or self.expired():
+				if not self.connect():
+					return 0, None if consume else ''
+			logins = self.logins
+		code, payload = self.limited(cmd, consume, data)
+		if code in [401,403]: # Session was dropped by the printer - log in again once
+			with self.lock:
+				if self.logins == logins: # Not already done by another thread
+					logger.debug(f'''Printer rejected session (code = {code}) - reconnecting''')
+					if not self.connect():
+						return code, None if consume else payload
+			code, payload = self.limited(cmd, consume, data)
+		self.lastUsed = time.time()
+		return code, payload
+
+	def limited(self, cmd, consume, data):
+		# One call within the connection limit - 503 (no more connections) waits for a connection to free up
+		loop = 0
+		while True:
+			self.slots.acquire() # Held until the body has been read
+			code = 0
+			try:
+				code, payload = self.call(cmd, consume, [x for x in retryCodes if x != 503], data)
+			finally:
+				self.slots.release(code == 503)
+			if code != 503 or loop >= httpRetries:
+				break
+			time.sleep(retryDelay(loop, None))
+			loop += 1
+		return code, payload
+
+	def call(self, cmd, consume, retryOn = None, data = None):
+		if data is not None:
+			return urlCall(f'''{self.url}{cmd}''', data, True, self.headers(), retryOn = retryOn)
+		if consume is None:
+			return urlCall(self.url, cmd, False, self.headers(), retryOn = retryOn)
+		code, r = urlCall(self.url, cmd, False, self.headers(), retryOn = retryOn, stream = True)
+		if r is None:
+			return code, None
+		try:
+			if code != 200:
+				return code, None
+			return code, consume(r)
+		finally:
+			r.close()
+
+class DsfSession(PrinterSession):
+	# DSF HTTP API on SBC printers - calls go straight to DSF instead of through the rr_ emulation
+	# Session handling is the same as rr_ - a session key is sent with every call
+	protocol = 'DSF'
+
+	def connectCommand(self):
+		return f'''/machine/connect?password={quote(self.password, safe='')}'''
+
+	def disconnectCommand(self):
+		return '/machine/disconnect'
 
-	return r.status_code, r.text
+	def downloadCommand(self, file):
+		return f'''/machine/file/{quote(f'0:{file}', safe='')}'''
 
-def reconnectPrinter():
-	urlCall(printerUrl, '/rr_disconnect', False) #Called blindly - does not return anything
-	result = loginPrinter()
-	return result
+	def gcode(self, command):
+		return self.request('/machine/code', data = command)
 
-def loginPrinter(): #logon and get key parameters
-	cmd = (f'''/rr_connect?sessionKey=yes&password={duetPassword}''') # using rr_ API
-	code, payload = urlCall(printerUrl, cmd, False)
-	if code in [200,204]:
+	def listDir(self, dir):
+		# Generator for the entries in dir - DSF returns the whole directory in one call
+		code, payload = self.request(f'''/machine/directory/{quote(dir, safe='')}''')
+		if code == 404:
+			msg = f'''Directory {dir} does not exist'''
+			logMessage('info',msg,'',False)
+			return
+		try:
+			if code != 200:
+				raise Exception(f'''code = {code}''')
+			entries = json.loads(payload)
+		except Exception as e:
+			msg = f'''Unknown error getting files from {dir}'''
+			logMessage('info',msg,str(e),True)
+			incompleteDirs.append(dir)
+			return
+		yield from entries
+
+	def probe(self):
+		# True if the printer answers the DSF API - standalone printers return 404
+		code, payload = urlCall(self.url, self.connectCommand(), False, retryOn = [])
+		if code != 200:
+			return False
+		try:
+			self.sessionKey = json.loads(payload).get('sessionKey')
+		except Exception:
+			return False
+		self.connected = True
+		self.lastUsed = time.time()
+		self.logins += 1
 		return True
-	elif code == 403:
-		msg = 'Password is invalid'
-	elif code == 503:
-		msg = 'No more connections available'
-	elif code == 502:
-		msg = 'Incorrect DCS version'
-	else:
-		msg = f'''Is the Printer turned on?.'''
-	
-	msg = f'''Login issue: {msg} code = {code}'''
-	logMessage('info',msg,'',True)
-	return False
+
+def connectPrinter():
+	# Use the DSF API if the printer has it (-protocol auto) - otherwise rr_
+	if protocol != 'rr':
+		session = DsfSession(printerUrl, duetPassword, downloadWorkers)
+		if protocol == 'dsf' or session.probe():
+			logger.info(f'''Using the {session.protocol} protocol''')
+			return session
+	session = PrinterSession(printerUrl, duetPassword, downloadWorkers)
+	logger.info(f'''Using the {session.protocol} protocol''')
+	return session
 
 ## Get config data from file
 class LoadFromFilex (argparse.Action):
@@ -257,12 +801,35 @@ def init():
 	parser.add_argument('-logfile', type=str, nargs=1, default=['/opt/dsf/sd/sys/duetBackup/duetBackup.log'], help='full logfile name')
 	#parser.add_argument('-file', type=argparse.FileType('r'), help='file of options', action=LoadFromFilex)
 	parser.add_argument('-duetIP', type=str, nargs=1, default=["127.0.0.1"], help='Duet3d Printer IP')
+	parser.add_argument('-timeout', type=float, nargs=1, default=[5], help='Seconds to wait for the printer to respond')
+	parser.add_argument('-retries', type=int, nargs=1, default=[3], help='Times to retry a failed printer call')
+	parser.add_argument('-downloadWorkers', type=int, nargs=1, default=[4], help='Maximum concurrent downloads from the printer')
+	parser.add_argument('-manifest', type=str, nargs=1, default=['/opt/dsf/sd/sys/duetBackup/duetBackup.manifest'], help='full manifest file name')
+	parser.add_argument('-fullScan', action='store_true', help='Download every file even if size and date are unchanged')
+	parser.add_argument('-maxFileSize', type=float, nargs=1, default=[100], help='Largest file (MB) to back up - larger files are skipped unless -lfs')
+	parser.add_argument('-lfs', action='store_true', help='Store files larger than -maxFileSize with Git LFS')
+	parser.add_argument('-lfsUrl', type=str, nargs=1, default=[''], help='Git LFS server - default is the Github LFS server for -rep')
+	parser.add_argument('-readmeOnChange', action='store_true', help='Only update README.md and backup.json when files have changed')
+	parser.add_argument('-githubCache', type=str, nargs=1, default=['/opt/dsf/sd/sys/duetBackup/duetBackup.cache'], help='full Github cache file name')
+	parser.add_argument('-watch', action='store_true', help='Back up changed files as soon as they are written (SBC only)')
+	parser.add_argument('-watchDelay', type=float, nargs=1, default=[5], help='Seconds with no further changes before backing up')
+	parser.add_argument('-sdRoot', type=str, nargs=1, default=['/opt/dsf/sd'], help='Local directory that holds the sd files (SBC)')
+	parser.add_argument('-protocol', type=str, nargs=1, choices=['auto', 'rr', 'dsf'], default=['auto'], help='Printer API - auto uses the DSF API if the printer has it')
+	parser.add_argument('-sink', type=str, nargs=1, choices=['api', 'mirror'], default=['api'], help='Commit through the Github API or a local mirror and git push')
+	parser.add_argument('-mirror', type=str, nargs=1, default=['/opt/dsf/sd/sys/duetBackup/mirror.git'], help='full path of the local mirror for -sink mirror')
+	parser.add_argument('-remote', type=str, nargs=1, default=[''], help='git URL to push to - default is the Github URL for -rep')
+	parser.add_argument('-metrics', type=str, nargs=1, default=[''], help='full Prometheus textfile name - a JSON snapshot is written alongside')
+	parser.add_argument('-trace', type=str, nargs=1, default=[''], help='full file name for a Chrome trace-event timeline of each backup')
+	parser.add_argument('-profile', action='store_true', help='With -trace - also write a cProfile dump of each backup')
+	parser.add_argument('-githubUrl', type=str, nargs=1, default=['https://api.github.com'], help='Github API url - for Github Enterprise or testing')
   
 	# Option to read from configuration file
 	parser.add_argument('-file', type=argparse.FileType('r'), help='file of options', action=LoadFromFilex)
 
 	global userName, userToken, dirs, gitignore, userRepo, main, backupInt, duetPassword, verbose, noDelete
-	global logfilename, duetIP
+	global logfilename, duetIP, httpTimeout, httpRetries, downloadWorkers, manifestfilename, fullScan
+	global maxFileSize, lfs, lfsUrl, readmeOnChange, cachefilename, watch, watchDelay, sdRoot, protocol
+	global sink, mirrorPath, remoteUrl, githubUrl, metricsfilename, tracefilename, profile
 
 	args = vars(parser.parse_args())  # Save as a dict
 
@@ -278,6 +845,32 @@ def init():
 	noDelete = args['noDelete']
 	logfilename = args['logfile'][0]
 	duetIP = args['duetIP'][0]
+	httpTimeout = args['timeout'][0]
+	httpRetries = args['retries'][0]
+	downloadWorkers = max(1, args['downloadWorkers'][0])
+	manifestfilename = args['manifest'][0]
+	fullScan = args['fullScan']
+	maxFileSize = int(args['maxFileSize'][0]*1024*1024)
+	githubUrl = args['githubUrl'][0].rstrip('/')
+	metricsfilename = args['metrics'][0]
+	tracefilename = args['trace'][0]
+	profile = args['profile']
+	webUrl = re.sub(r'/api/v3$', '', githubUrl.replace('://api.', '://', 1)) # Where git and LFS are served
+	lfs = args['lfs']
+	lfsUrl = args['lfsUrl'][0]
+	if lfsUrl == '':
+		lfsUrl = f'''{webUrl}/{userName}/{userRepo}.git/info/lfs'''
+	readmeOnChange = args['readmeOnChange']
+	cachefilename = args['githubCache'][0]
+	watch = args['watch']
+	watchDelay = max(0.5, args['watchDelay'][0])
+	sdRoot = args['sdRoot'][0].rstrip('/')
+	protocol = args['protocol'][0]
+	sink = args['sink'][0]
+	mirrorPath = args['mirror'][0]
+	remoteUrl = args['remote'][0]
+	if remoteUrl == '':
+		remoteUrl = f'''{webUrl}/{userName}/{userRepo}.git'''
 
 def update_list(list,alias,real):
 	if len(list) == 0 or (len(list) == 1 and list[0] == []):
@@ -328,7 +921,7 @@ def check_for_mandatory():
 		force_quit(1)
 
 def list_options():
-	global deleteFiles, dirs, gitignore, noDelete
+	global deleteFiles, dirs, gitignore, noDelete, ignoreMatcher
 
 	msg = 'The following dir(s) will be backed up:'
 	logMessage('info',msg,'',True)
@@ -345,6 +938,7 @@ def list_options():
 		gitignore[:] = [x for x in gitignore if x != []] #get rid of empty entries
 		for ignore in gitignore:
 			logger.info(f'''-ignore {ignore[0]}''')
+	ignoreMatcher = IgnoreMatcher([x[0] for x in gitignore if x != []], ownFiles())
 
 	if noDelete == []: # option omitted
 		msg = 'Files will be synced'
@@ -360,30 +954,277 @@ def list_options():
 		for dir in noDelete:
 			logger.info(f'''-noDelete {dir[0]}''')
 
+def ownFiles():
+	# Repository paths of the files duetBackup writes on the SD card e.g. sd/sys/duetBackup/duetBackup.manifest
+	# They change on every run so they are never backed up
+	own = []
+	root = os.path.abspath(sdRoot)
+	names = [manifestfilename, cachefilename, logfilename]
+	if metricsfilename != '':
+		names += [metricsfilename, f'''{os.path.splitext(metricsfilename)[0]}.json''']
+	if tracefilename != '':
+		names += [tracefilename, f'''{os.path.splitext(tracefilename)[0]}.prof''']
+	paths = [os.path.abspath(x) for name in names for x in [name, f'''{name}.tmp''']]
+	paths.append(os.path.abspath(mirrorPath)) # A directory - nothing in it is listed, even if -sink is now api
+	for local in paths:
+		if local.startswith(f'''{root}/'''):
+			own.append(f'''sd{local[len(root):]}''')
+	for path in own:
+		logger.debug(f'''Not backed up (written by {progName}) {path}''')
+	return own
+
+class GithubScheduler:
+	# Every Github API call goes through here so that a large backup does not run into the rate limit
+	# Github sends the calls remaining and the reset time with each response
+	# Calls are spaced out when the quota runs low and paused until the reset when it is used up
+	paceBelow = 0.1 # Start spacing calls when less than this fraction of the limit is left
+	reserve = 5 # Pause rather than use the last few calls
+	maxPause = 3700 # seconds - the limit resets every hour
+
+	def __init__(self):
+		self.client = None
+		self.remaining = None # Unknown until the first response
+		self.limit = None
+		self.reset = 0 # epoch seconds
+		self.calls = 0
+		self.lock = threading.Lock()
+
+	def call(self, endpoint, func, *args, **kwargs):
+		# Run one PyGithub call - the quota is read back from the client afterwards
+		# endpoint is the metrics label e.g. POST {repo}/git/trees - the same as for calls made without PyGithub
+		attempt = 0
+		while True:
+			self.wait()
+			try:
+				return self.timed(endpoint, func, attempt, *args, **kwargs)
+			except RateLimitExceededException as e:
+				if not self.observe(e.headers or {}, e.status): # Secondary (abuse) limit - not the hourly quota
+					if attempt >= httpRetries:
+						raise
+					time.sleep(60) # Github asks for at least a minute
+				attempt += 1
+			finally:
+				self.fromClient()
+
+	def timed(self, endpoint, func, attempt, *args, **kwargs):
+		start = time.monotonic()
+		code = 0 # No response
+		try:
+			result = func(*args, **kwargs)
+			code = 200
+			return result
+		except GithubException as e:
+			code = e.status
+			raise
+		finally:
+			metrics.request('github', endpoint, time.monotonic() - start, code, retry = attempt > 0)
+
+	def wait(self):
+		with self.lock:
+			self.calls += 1
+			if self.remaining is None:
+				return
+			left = self.reset - time.time()
+			if left <= 0: # A new window has started
+				self.remaining = None
+				return
+			if self.remaining <= self.reserve:
+				self.pause(left)
+			elif self.remaining < self.limit * self.paceBelow:
+				delay = left / (self.remaining - self.reserve)
+				logger.debug(f'''Github rate limit - {self.remaining} calls left, waiting {delay:.1f} seconds''')
+				time.sleep(delay)
+				self.remaining -= 1 # Until the response says otherwise
+
+	def pause(self, left):
+		left = min(max(left + 1, 1), self.maxPause)
+		msg = f'''Github rate limit reached - backup paused for {int(left/60)+1} minute(s)'''
+		logMessage('info',msg,'',True)
+		sendDuetGcode(f'''M291 S1 T20 P"{msg}"''')
+		time.sleep(left)
+		self.remaining = None
+
+	def fromClient(self):
+		if self.client is None:
+			return
+		remaining, limit = self.client.requester.rate_limiting
+		if limit <= 0: # No response with rate limit headers yet
+			return
+		with self.lock:
+			self.remaining = remaining
+			self.limit = limit
+			self.reset = self.client.requester.rate_limiting_resettime
+
+	def observe(self, headers, code):
+		# Headers from a call made without PyGithub
+		# Returns True if the call was refused because of the rate limit - after waiting for the reset
+		try:
+			remaining = int(headers['X-RateLimit-Remaining'])
+			limit = int(headers['X-RateLimit-Limit'])
+			reset = int(headers['X-RateLimit-Reset'])
+		except (KeyError, ValueError, TypeError):
+			return False
+		with self.lock:
+			self.remaining = remaining
+			self.limit = limit
+			self.reset = reset
+			if code in [403,429] and remaining == 0:
+				self.pause(reset - time.time())
+				return True
+		return False
+
+	def predict(self, files):
+		# Logs how many calls a backup will need compared with what is left
+		# files is the number of files in the last backup - each could need its own upload
+		# With no manifest (first backup) the number of files is not known until the walk
+		least = 7 # listing (2) and commit (5)
+		if files == 0:
+			msg = f'''Github calls for this backup: at least {least} - no manifest, so up to one more for every file found'''
+		else:
+			msg = f'''Github calls for this backup: between {least} and {least + files}'''
+		if self.remaining is not None:
+			msg = f'''{msg} - {self.remaining} of {self.limit} left until {datetime.fromtimestamp(self.reset).strftime('%H:%M')}'''
+			if files == 0:
+				msg = f'''{msg} - with more than {max(self.remaining - least, 0)} files to upload the backup will pause until the limit resets'''
+			elif least + files > self.remaining:
+				msg = f'''{msg} - the backup may pause until the limit resets'''
+		logMessage('info',msg,'',False)
+		self.calls = 0 # Count the calls made by the backup itself
+
+	def report(self):
+		remaining = '' if self.remaining is None else f''' - {self.remaining} left'''
+		logger.info(f'''{self.calls} Github call(s) made{remaining}''')
+
+githubScheduler = GithubScheduler()
+
+class GithubCache:
+	# Conditional GETs for Github reads - the cache is kept on disk between runs
+	# Github answers 304 Not Modified when the ETag (or date) still matches
+	# A 304 does not count against the rate limit and has no body to transfer
+	def __init__(self):
+		self.entries = {} # url: {'etag', 'modified', 'body'}
+		self.used = set() # urls read since the last save
+		self.hits = 0
+		self.lock = threading.Lock()
+
+	def load(self):
+		try:
+			with open(cachefilename, 'r', encoding='utf-8') as f:
+				saved = json.load(f)
+			if saved.get('user') == userName: # Responses depend on who asked
+				self.entries = saved['entries']
+				logger.debug(f'''Loaded Github cache with {len(self.entries)} entries''')
+		except FileNotFoundError:
+			pass
+		except Exception as e:
+			msg = f'''Could not read Github cache {cachefilename}'''
+			logMessage('info',msg,str(e),True)
+
+	def save(self):
+		# Only entries read since the last save are kept so the cache does not keep growing
+		with self.lock:
+			self.entries = {url: entry for url, entry in self.entries.items() if url in self.used}
+			self.used = set()
+			hits = self.hits
+			self.hits = 0
+		logger.debug(f'''{hits} Github read(s) answered from the cache''')
+		try:
+			tempname = f'''{cachefilename}.tmp'''
+			with open(tempname, 'w', encoding='utf-8') as f:
+				json.dump({'user': userName, 'entries': self.entries}, f)
+			os.replace(tempname, cachefilename)
+		except Exception as e:
+			msg = f'''Could not save Github cache {cachefilename}'''
+			logMessage('info',msg,str(e),True)
+
+	def get(self, url):
+		# Returns the decoded JSON for url - from the cache if Github says it has not changed
+		headers = {'Authorization': f'''token {userToken}''', 'Accept': 'application/vnd.github+json'}
+		with self.lock:
+			cached = self.entries.get(url)
+			self.used.add(url)
+		if cached is not None:
+			if cached['etag']:
+				headers['If-None-Match'] = cached['etag']
+			elif cached['modified']:
+				headers['If-Modified-Since'] = cached['modified']
+		loop = 0
+		while True:
+			r = None
+			githubScheduler.wait()
+			start = time.monotonic()
+			try:
+				r = getHttpSession(url).get(url, headers=headers, timeout=githubTimeout)
+			except (requests.ConnectionError, requests.exceptions.Timeout) as e:
+				logger.debug(f'''Github read failed - {str(e)}''')
+			metrics.request('github', metrics.endpoint('GET', url), time.monotonic() - start, 0 if r is None else r.status_code,
+				received = 0 if r is None else len(r.content), retry = loop > 0)
+			if r is not None and githubScheduler.observe(r.headers, r.status_code):
+				continue # Waited for the rate limit to reset
+			if r is not None and r.status_code not in retryCodes:
+				break
+			if loop >= httpRetries:
+				break
+			time.sleep(retryDelay(loop, r))
+			loop += 1
+		if r is None:
+			raise Exception(f'''No response from Github for {url}''')
+		if r.status_code == 304 and cached is not None:
+			metrics.count('github_cache_hits')
+			with self.lock:
+				self.hits += 1
+			return cached['body']
+		if r.status_code != 200:
+			raise Exception(f'''Github read failed - code = {r.status_code} {r.text}''')
+		body = r.json()
+		with self.lock:
+			self.entries[url] = {'etag': r.headers.get('ETag'), 'modified': r.headers.get('Last-Modified'), 'body': body}
+		return body
+
+githubCache = GithubCache()
+
+githubClient = None # One client for the life of the program
+headCommit = {'sha': None, 'date': None} # Last commit seen at the head of the main branch
 
 def loginGithub(user, token, repo):
-	g = None
-	repository = None
-	try:
+	# No call is made here - the token is checked by the first call that uses it
+	global githubClient
+	if githubClient is None:
 		logger.info(f'''Logging into Github as {user}''')
-		g = Github(user, token)
-		repository = g.get_user().get_repo(repo)
-		last_commit_git = repository.get_commits()[0].last_modified
-		logger.debug(f'''Git reported last backup on {last_commit_git}''')
-		return repository, last_commit_git
+		githubClient = Github(user, token, base_url=githubUrl)
+		githubScheduler.client = githubClient
+	url = f'''{githubClient.requester.base_url}/repos/{user}/{repo}'''
+	return githubClient.create_from_raw_data(Repository, {'url': url, 'name': repo, 'full_name': f'''{user}/{repo}'''})
+
+def lastBackupTime(repository):
+	# Time (UTC) of the commit at the head of the main branch
+	# One ref lookup - the commit is only read again when the head has moved
+	try:
+		if gitMirror is not None: # Also brings the mirror up to date
+			gitMirror.fetch()
+			return gitMirror.headTime(main)
+		ref = githubCache.get(f'''{repository.url}/git/ref/heads/{main}''')
+		sha = ref['object']['sha']
+		if sha != headCommit['sha']:
+			commit = githubCache.get(f'''{repository.url}/git/commits/{sha}''')
+			headCommit['date'] = datetime.fromisoformat(commit['committer']['date'].replace('Z', '+00:00'))
+			headCommit['sha'] = sha
+		logger.debug(f'''Git reported last backup on {headCommit['date']}''')
+		return headCommit['date']
 	except Exception as e:
-		msg = f'''Could not log into repository {repo}'''
+		msg = f'''Could not log into repository {repository.name}'''
 		logMessage('critical',msg,str(e),True)
 		sendDuetGcode(f'''M291 S1 T0 P"{msg}"''')
 		force_quit(1)
 
-def wait_until_backup_needed(last_commit_git, backupInt):
+def wait_until_backup_needed(last_commit_utc, backupInt, lastRun = None):
 	# Check to see if a backup is needed else wait
-	# setup date objects
-	# Work in GMT
+	# last_commit_utc is the time of the last commit (datetime in UTC)
+	# lastRun is the local time of the last backup run - a run with no changes makes no commit
 	while True:
-		last_commit_date = re.findall("\d\d \w\w\w \d\d\d\d \d\d:\d\d:\d\d", last_commit_git)
-		last_commit_dt = datetime.strptime(last_commit_date[0], '%d %b %Y %H:%M:%S') + timedelta(seconds=TimeZoneOffset) # local time
+		last_commit_dt = last_commit_utc.replace(tzinfo=None) + timedelta(seconds=TimeZoneOffset) # local time
+		if lastRun is not None and lastRun > last_commit_dt:
+			last_commit_dt = lastRun
 		last_commit_str = last_commit_dt.strftime('%d %b %Y %H:%M')
 		logger.info(f'''\nLast backup to Github was {last_commit_str} Local Time (TZ = {TimeZoneOffsetHrs:+.1f} hrs)''')
 		
@@ -410,226 +1251,1026 @@ def wait_until_backup_needed(last_commit_git, backupInt):
 
 def list_files_in_repo(repository,branch):
 	# repository is repository object
-	branch_files = []
-	branches = repository.get_branches()
-	existing_branches = []
-	for br in branches:
-		existing_branches.append(br.name)
-
-	if branch not in existing_branches: 
+	# Returns a dict of path: FileRecord for every file in the branch
+	if gitMirror is not None:
+		return gitMirror.listFiles(branch)
+	branch_files = {}
+	try:
+		head = githubCache.get(f'''{repository.url}/branches/{branch}''')
+	except Exception as e:
 		msg = f'''Branch {branch} does not exist in repository {repository}'''
-		logMessage('error',msg,'',True)
+		logMessage('error',msg,str(e),True)
 		sendDuetGcode(f'''M291 S1 T0 P"{msg}"''')
 		return branch_files
 	
 	msg = f'''Getting files in {repository} from branch {branch}'''
 	logMessage('info',msg,'',True)
 	try:
-		contents = repository.get_contents("", ref=branch)
-		while contents:
-			file_content = contents.pop(0)
-			if file_content.type == "dir":
-				contents.extend(repository.get_contents(file_content.path))
-			else:
-				file = file_content
-				branch_files.append(str(file).replace('ContentFile(path="','').replace('")',''))
+		root_sha = head['commit']['commit']['tree']['sha']
+		tree = getTree(repository, root_sha, recursive=True)
+		if not tree.get('truncated', False): # Normal case - whole branch in one call
+			addTreeFiles(tree, '', branch_files)
+		else:
+			# Github limits the size of a recursive tree - only list the dirs being backed up
+			msg = f'''Tree for branch {branch} is too large for one call - listing -dir entries only'''
+			logMessage('info',msg,'',True)
+			root = getTree(repository, root_sha)
+			addTreeFiles(root, '', branch_files) # e.g. README.md
+			listed = []
+			for dir in sorted(x[0].strip('/') for x in dirs):
+				if any(dir == done or dir.startswith(f'''{done}/''') for done in listed):
+					continue # already covered by a parent dir
+				listed.append(dir)
+				subtree_sha = findSubtree(repository, root, dir)
+				if subtree_sha is not None:
+					list_subtree(repository, subtree_sha, f'''{dir}/''', branch_files)
 	except Exception as e:
 		msg = f'''Problem getting files from {repository}'''
 		logMessage('error',msg,str(e),True)
 		sendDuetGcode(f'''M291 S1 T0 P"{msg}"''')
+	logger.debug(f'''{len(branch_files)} files in branch {branch}''')
 	return branch_files
 
-
-def getFiles(dir):
-	if reconnectPrinter() :
-		command = f'''/rr_filelist?first=0&dir={dir}'''
-		code, payload = urlCall(printerUrl, command, False) # Get form
-		j = []
-		entries = []
-		if code == 200:
-			try:
-				j = json.loads(payload)
-				status = j['err']
-				if status == 0 and j['next'] == 0: #compete list
-					entries = j['files']
-				elif status == 1: # Drive does not exist
-					msg = f'''Drive {dir} does not exist'''
-				elif status == 2: # Directory  does not exist
-					msg = f'''Directory {dir} does not exist'''
-			except Exception as e:
-				msg = f'''Unknown error getting files from {dir}'''
-				logMessage('info',msg,str(e),True)
-			finally:
-				if status > 0:
-					logMessage('info',msg,'',False)
-				return entries
-	return []
-
-def getDuetFiles(dir,filelist = None):
-	# Recursive function
-	# Top level call needs filelist set to [] or omitted
-	if filelist is None:
-		filelist = []
+def listRepository(repository, branch):
+	with metrics.phase('listing'):
+		return list_files_in_repo(repository, branch)
+
+def getTree(repository, sha, recursive = False):
+	# Git trees never change for a given sha - after the first read they come from the cache
+	url = f'''{repository.url}/git/trees/{sha}'''
+	if recursive:
+		url = f'''{url}?recursive=1'''
+	return githubCache.get(url)
+
+def addTreeFiles(tree, prefix, branch_files):
+	for element in tree['tree']:
+		if element['type'] == 'blob':
+			record = FileRecord(f'''{prefix}{element['path']}''', element.get('size'), sha = element['sha'])
+			branch_files[record.path] = record
+
+def findSubtree(repository, root, dir):
+	# Walk down one level at a time to the tree for dir
+	tree = root
+	parts = dir.split('/')
+	for i, part in enumerate(parts):
+		match = [x for x in tree['tree'] if x['path'] == part and x['type'] == 'tree']
+		if match == []:
+			return None # Not in the repo yet
+		if i == len(parts) - 1:
+			return match[0]['sha']
+		tree = getTree(repository, match[0]['sha'])
+	return None
+
+def list_subtree(repository, tree_sha, prefix, branch_files):
+	# Recursive listing of one subtree - if still truncated then split by subdirectory
+	tree = getTree(repository, tree_sha, recursive=True)
+	if not tree.get('truncated', False):
+		addTreeFiles(tree, prefix, branch_files)
+		return
+	tree = getTree(repository, tree_sha)
+	addTreeFiles(tree, prefix, branch_files)
+	for element in tree['tree']:
+		if element['type'] == 'tree':
+			list_subtree(repository, element['sha'], f'''{prefix}{element['path']}/''', branch_files)
+
+def getDuetFiles(dir):
+	# Recursive generator - (file, size, date) is yielded as each directory is listed
+	# Ignored files are dropped and ignored directories are never listed
 	msg = f'''Getting files in {dir}'''
 	logMessage('debug',msg,'',True)
 	# get the files in the current dir
-	entries = getFiles(dir)
-	if entries != []:
-		moredirs = []
-		for entry in entries:
-			if entry['type'] == 'd':
-				moredirs.append(f'''{dir}{entry["name"]}/''')
-			if entry['type'] == 'f':
-				filelist.append(f'''{dir.replace('0:/','sd/',1)}{entry['name']}''')	
-		for nextdir in moredirs:
-			filelist = getDuetFiles(nextdir,filelist)
-	return filelist
+	entries = printer.listDir(dir)
+	moredirs = []
+	sddir = dir.replace('0:/','sd/',1)
+	for entry in entries:
+		if entry['type'] == 'd':
+			if ignoreMatcher.pruneDir(f'''{sddir}{entry["name"]}'''):
+				logger.debug(f'''Ignoring directory {sddir}{entry["name"]}''')
+				continue
+			moredirs.append(f'''{dir}{entry["name"]}/''')
+		if entry['type'] == 'f':
+			filename = f'''{sddir}{entry['name']}'''
+			if ignoreMatcher.ignored(filename):
+				logger.debug(f'''Ignoring {filename}''')
+				continue
+			yield filename, entry.get('size'), entry.get('date')
+	for nextdir in moredirs:
+		yield from getDuetFiles(nextdir)
 
 def get_list_of_source_files(dirs):
-	# Get a complete list of source files
-	sourcefiles = []
+	# Generator for the source files - the walk feeds the backup as it goes
+	top = ''
 	try:
 		for dir in dirs:
+			top = dir[0]
+			if ignoreMatcher.pruneDir(dir[0].rstrip('/')):
+				logger.info(f'''-dir {dir[0]} is ignored''')
+				continue
+			if localSource is not None:
+				yield from localSource.walk(dir[0].rstrip('/'))
+				continue
 			dir = f'''{dir[0].replace('sd/','0:/')}'''
 			if not dir.endswith('/'):
 				dir = dir + '/'
-			list = getDuetFiles(dir,[]) # can optionally omit second argument
-			if list != []:
-				for filename in list:
-					if not ignoreFile(filename):
-						sourcefiles.append(filename)
+			yield from getDuetFiles(dir)
 	except Exception as e:
+			incompleteDirs.append(top) # The rest of the walk is missing - nothing can be deleted
 			logMessage('info',str(e),'',True)
 			sendDuetGcode(f'''M291 S1 T0 P"{str(e)}"''')
-	
-	return sourcefiles
    
-def ignoreFile(filename):
-	for ignore in gitignore:
-		logger.debug(f'''Checking {filename} for ignore {ignore[0]}''')
-		if fnmatch(filename,ignore[0]): # filename matches ignore condition
-			logger.debug(f'''Ignoring {filename} because of match with {ignore[0]}''') 
+class LocalSource:
+	# Reads the sd files straight from the SBC filesystem instead of through the printer
+	# Paths are the same as from the printer e.g. sd/sys/config.g is {root}/sys/config.g
+	def __init__(self, root):
+		self.root = root
+
+	def localPath(self, path):
+		return f'''{self.root}{path[2:]}'''
+
+	def walk(self, sddir):
+		# Same as getDuetFiles - (file, size, date) is yielded as each directory is listed
+		try:
+			with os.scandir(self.localPath(sddir)) as it:
+				entries = list(it)
+		except FileNotFoundError:
+			msg = f'''Directory {sddir} does not exist'''
+			logMessage('info',msg,'',False)
+			return
+		except OSError as e:
+			msg = f'''Could not list {sddir}'''
+			logMessage('info',msg,str(e),True)
+			incompleteDirs.append(sddir)
+			return
+		moredirs = []
+		for entry in entries:
+			path = f'''{sddir}/{entry.name}'''
+			try:
+				if entry.is_dir(follow_symlinks=False):
+					if ignoreMatcher.pruneDir(path):
+						logger.debug(f'''Ignoring directory {path}''')
+						continue
+					moredirs.append(path)
+				elif entry.is_file():
+					if ignoreMatcher.ignored(path):
+						logger.debug(f'''Ignoring {path}''')
+						continue
+					st = entry.stat()
+					# Same date format as the printer so the manifest works with either
+					yield path, st.st_size, datetime.fromtimestamp(st.st_mtime).strftime('%Y-%m-%dT%H:%M:%S')
+			except OSError as e: # Removed while listing
+				logger.debug(f'''Could not read {path} - {str(e)}''')
+		for nextdir in moredirs:
+			yield from self.walk(nextdir)
+
+	def read(self, filepath, size = None):
+		# Returns LocalFile, hash, oid - the file is hashed in place, a chunk at a time into a reused buffer
+		# It is only copied (by stageFile) if it has to be uploaded
+		buffer = getattr(readBuffers, 'buffer', None)
+		if buffer is None:
+			buffer = readBuffers.buffer = memoryview(bytearray(chunkSize))
+		local = self.localPath(filepath)
+		with open(local, 'rb', buffering=0) as f:
+			size = os.fstat(f.fileno()).st_size
+			blob = BlobHash(size, useLfs(size))
+			for length in iter(lambda: f.readinto(buffer), 0):
+				blob.update(buffer[:length])
+			file_hash = blob.hexdigest(f)
+		return LocalFile(local), file_hash, blob.lfsOid()
+
+class LocalFile:
+	# Content of a file on the local SD card that has been hashed but not copied
+	def __init__(self, local):
+		self.local = local
+
+	def copy(self):
+		# Returns spool, hash, oid of the file as it is now - it cannot change while it is uploaded
+		with open(self.local, 'rb') as f:
+			return spoolChunks(iter(lambda: f.read(chunkSize), b''), os.fstat(f.fileno()).st_size)
+
+	def close(self):
+		pass
+
+readBuffers = threading.local() # One buffer for each thread that hashes local files
+localSource = None # Set if the sd files can be read directly
+
+def selectSource():
+	# On the SBC the sd files are on the same machine - read them directly
+	global localSource
+	host = duetIP.split(':')[0]
+	if host in ['127.0.0.1', 'localhost'] and os.path.isdir(sdRoot):
+		localSource = LocalSource(sdRoot)
+		logger.info(f'''Reading files directly from {sdRoot}''')
+
+class IgnoreMatcher:
+	# The -ignore patterns compiled once, using .gitignore rules
+	# * and ? do not match / - ** matches any number of directories
+	# A pattern without a / (other than at the end) matches the name at any level e.g. *.log
+	# A pattern ending in / only matches directories - !pattern includes a file again
+	# own - files and directories that are always ignored (see ownFiles)
+	def __init__(self, patterns, own = ()):
+		self.own = set(own)
+		self.rules = [] # (regex, negate, dirOnly) in the order given - the last match wins
+		self.prefixes = [] # Directories where every entry is ignored e.g. sd/gcodes/archive/**
+		for pattern in patterns:
+			negate = pattern.startswith('!')
+			if negate:
+				pattern = pattern[1:]
+			dirOnly = pattern.endswith('/')
+			pattern = pattern.rstrip('/')
+			if pattern == '':
+				continue
+			anchored = '/' in pattern
+			pattern = pattern.lstrip('/')
+			self.rules.append((re.compile(self.translate(pattern, anchored)), negate, dirOnly))
+			if not negate and not dirOnly and anchored:
+				for ending in ['/**', '/*']:
+					head = pattern[:-len(ending)]
+					if pattern.endswith(ending) and not any(c in head for c in '*?['):
+						self.prefixes.append(head)
+		self.negation = any(rule[1] for rule in self.rules)
+		if not self.negation:
+			# Nothing can be included again - any match will do, so use one combined expression
+			self.fileRegex = self.combine([rule[0] for rule in self.rules if not rule[2]])
+			self.dirRegex = self.combine([rule[0] for rule in self.rules])
+
+	@staticmethod
+	def translate(pattern, anchored):
+		# gitignore pattern to regular expression
+		regex = '' if anchored else '(?:.*/)?'
+		i = 0
+		while i < len(pattern):
+			c = pattern[i]
+			if pattern.startswith('**/', i):
+				regex += '(?:.*/)?'
+				i += 3
+				continue
+			if pattern.startswith('**', i):
+				regex += '.*'
+				i += 2
+				continue
+			if c == '*':
+				regex += '[^/]*'
+			elif c == '?':
+				regex += '[^/]'
+			elif c == '[':
+				close = pattern.find(']', i + 2 if pattern[i+1:i+2] in ['!', '^'] else i + 1)
+				if close == -1:
+					regex += re.escape(c)
+				else:
+					body = pattern[i+1:close]
+					if body.startswith('!'):
+						body = '^' + body[1:]
+					regex += f'''[{body.replace(chr(92), chr(92)*2)}]'''
+					i = close
+			else:
+				regex += re.escape(c)
+			i += 1
+		return f'''^{regex}$'''
+
+	@staticmethod
+	def combine(regexes):
+		if regexes == []:
+			return None
+		return re.compile('|'.join(f'''(?:{x.pattern})''' for x in regexes))
+
+	def match(self, path, isDir):
+		if path in self.own:
 			return True
-	return False
+		if not self.negation:
+			regex = self.dirRegex if isDir else self.fileRegex
+			return regex is not None and regex.match(path) is not None
+		ignore = False
+		for regex, negate, dirOnly in self.rules:
+			if dirOnly and not isDir:
+				continue
+			if regex.match(path):
+				ignore = not negate
+		return ignore
+
+	def pruneDir(self, path):
+		# True if nothing in the directory can be backed up - it does not need to be listed
+		if self.match(path, True):
+			return True # Files in an ignored directory cannot be included again
+		if not self.negation:
+			for prefix in self.prefixes:
+				if path == prefix or path.startswith(f'''{prefix}/'''):
+					return True
+		return False
+
+	def ignored(self, path):
+		# For a file found by the walk - its directories have already been checked
+		return self.match(path, False)
+
+	def ignoredPath(self, path):
+		# For a file found some other way - checks each directory above it as well
+		parts = path.split('/')
+		for i in range(1, len(parts)):
+			if self.pruneDir('/'.join(parts[:i])):
+				return True
+		return self.match(path, False)
+
+class Base64Body:
+	# File-like JSON body for a blob upload - the content is base64 encoded as it is read
+	# The length is known up front so the upload is not chunked
+	prefix = b'''{"encoding": "base64", "content": "'''
+	suffix = b'''"}'''
+
+	def __init__(self, filecontent, size):
+		self.source = filecontent
+		self.length = len(self.prefix) + 4*((size+2)//3) + len(self.suffix)
+		self.buffer = bytearray(self.prefix)
+		self.done = False
+
+	def __len__(self):
+		return self.length
+
+	def read(self, n = -1):
+		while (n is None or n < 0 or len(self.buffer) < n) and not self.done:
+			chunk = self.source.read(chunkSize*3) # Multiple of 3 - no padding until the end
+			if chunk:
+				self.buffer += base64.b64encode(chunk)
+			else:
+				self.buffer += self.suffix
+				self.done = True
+		if n is None or n < 0:
+			n = len(self.buffer)
+		data = bytes(self.buffer[:n])
+		del self.buffer[:n]
+		return data
+
+class CommitBatch:
+	# Collects all the changes from a backup run and applies them as a single commit
+	# Uses the Git Data API: blobs -> tree -> commit -> ref update
+	inlineFileLimit = 64*1024 # Small files are sent inside the tree request
+	inlineTotalLimit = 8*1024*1024 # Keeps the tree request to a reasonable size
+
+	def __init__(self, repo, branch):
+		self.repo = repo
+		self.branch = branch
+		self.elements = [] # One tree entry per added, updated or deleted file
+		self.inlineSize = 0
+
+	def addFile(self, filepath, filecontent, oid = None):
+		# filecontent is a binary file object positioned at the start
+		# Only changed content is uploaded - unchanged files are carried over by the base tree
+		# Size decides the path: small text inline in the tree, larger as a blob, oid set - Git LFS
+		size = filecontent.seek(0, os.SEEK_END)
+		filecontent.seek(0)
+		if oid is not None:
+			uploadLfsObject(filecontent, oid, size)
+			self.elements.append(InputGitTreeElement(filepath, '100644', 'blob', content=lfsPointer(oid, size).decode('ascii')))
+			return
+		if size <= self.inlineFileLimit and self.inlineSize + size <= self.inlineTotalLimit:
+			try:
+				text = filecontent.read().decode('utf-8') # Only text can be sent inside the tree request
+			except UnicodeDecodeError:
+				text = None
+				filecontent.seek(0)
+			if text is not None:
+				self.inlineSize += size # No separate call - Github creates the blob with the tree
+				self.elements.append(InputGitTreeElement(filepath, '100644', 'blob', content=text))
+				return
+		sha = self.uploadBlob(filecontent, size)
+		self.elements.append(InputGitTreeElement(filepath, '100644', 'blob', sha=sha))
+
+	def uploadBlob(self, filecontent, size):
+		# Streams the content to Github as base64 - the file is never held in memory
+		url = f'''{self.repo.url}/git/blobs'''
+		headers = {'Authorization': f'''token {userToken}''', 'Accept': 'application/vnd.github+json', 'Content-Type': 'application/json'}
+		loop = 0
+		while True:
+			filecontent.seek(0)
+			r = None
+			githubScheduler.wait()
+			body = Base64Body(filecontent, size)
+			start = time.monotonic()
+			try:
+				r = getHttpSession(url).post(url, data=body, headers=headers, timeout=githubTimeout)
+			except (requests.ConnectionError, requests.exceptions.Timeout) as e:
+				logger.debug(f'''Blob upload failed - {str(e)}''')
+			metrics.request('github', metrics.endpoint('POST', url), time.monotonic() - start, 0 if r is None else r.status_code,
+				len(body), 0 if r is None else len(r.content), loop > 0)
+			if r is not None and githubScheduler.observe(r.headers, r.status_code):
+				continue # Waited for the rate limit to reset
+			if r is not None and r.status_code not in retryCodes:
+				break
+			if loop >= httpRetries:
+				break
+			time.sleep(retryDelay(loop, r))
+			loop += 1
+		if r is None:
+			raise Exception('No response from Github uploading blob')
+		if r.status_code != 201:
+			raise Exception(f'''Github blob upload failed - code = {r.status_code} {r.text}''')
+		return r.json()['sha']
+
+	def deleteFile(self, filepath):
+		self.elements.append(InputGitTreeElement(filepath, '100644', 'blob', sha=None))
+
+	def hasChanges(self):
+		return self.elements != []
+
+	def commit(self, message):
+		# Build one tree on top of the current head and move the branch once
+		url = self.repo.url
+		ref = githubScheduler.call(metrics.endpoint('GET', f'''{url}/git/ref/heads/{self.branch}'''), self.repo.get_git_ref, f'''heads/{self.branch}''')
+		head = githubScheduler.call(metrics.endpoint('GET', f'''{url}/git/commits/{ref.object.sha}'''), self.repo.get_git_commit, ref.object.sha)
+		tree = githubScheduler.call(metrics.endpoint('POST', f'''{url}/git/trees'''), self.repo.create_git_tree, self.elements, base_tree=head.tree)
+		commit = githubScheduler.call(metrics.endpoint('POST', f'''{url}/git/commits'''), self.repo.create_git_commit, message, tree, [head])
+		githubScheduler.call(metrics.endpoint('PATCH', f'''{url}/git/refs/heads/{self.branch}'''), ref.edit, commit.sha)
+		return commit.sha
+
+class GitMirror:
+	# Local bare copy of -rep - backups are committed here and sent to Github with a single push
+	# Uses the git command line - git sends only the objects the remote does not have, as one pack
+	def __init__(self, path, remote):
+		self.path = path
+		self.remote = remote
+		self.env = dict(os.environ, GIT_DIR=path, GIT_TERMINAL_PROMPT='0')
+		email = f'''{userName}@users.noreply.github.com'''
+		self.env.update({'GIT_AUTHOR_NAME': userName, 'GIT_AUTHOR_EMAIL': email, 'GIT_COMMITTER_NAME': userName, 'GIT_COMMITTER_EMAIL': email})
+		self.remoteEnv = self.env # Only used for fetch and push - the token is not written to the mirror
+		if remote.startswith('http'):
+			# Passed in the environment (git 2.31 or later) - the command line can be read by any user with ps
+			auth = base64.b64encode(f'''{userName}:{userToken}'''.encode('utf-8')).decode('ascii')
+			count = int(self.env.get('GIT_CONFIG_COUNT') or 0)
+			self.remoteEnv = dict(self.env, GIT_CONFIG_COUNT=str(count + 1))
+			self.remoteEnv[f'''GIT_CONFIG_KEY_{count}'''] = 'http.extraHeader'
+			self.remoteEnv[f'''GIT_CONFIG_VALUE_{count}'''] = f'''Authorization: Basic {auth}'''
+		if not os.path.isdir(path):
+			logger.info(f'''Creating local mirror {path}''')
+			os.makedirs(path)
+			self.git('init', '--quiet', '--bare')
+
+	def git(self, *args, input = None, env = None, remote = False):
+		# Returns stdout as bytes - remote adds the Github login for fetch and push
+		if env is None:
+			env = self.remoteEnv if remote else self.env
+		start = time.monotonic()
+		r = subprocess.run(['git'] + list(args), input=input, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+		metrics.request('git', args[0], time.monotonic() - start, r.returncode, len(input or b''), len(r.stdout))
+		if r.returncode != 0:
+			raise Exception(f'''git {args[0]} failed - {r.stderr.decode('utf-8', 'replace').strip()}''')
+		return r.stdout
+
+	def fetch(self):
+		# Only the commits made since the last fetch are transferred
+		logger.debug(f'''Fetching {self.remote} into {self.path}''')
+		self.git('fetch', '--quiet', '--prune', '--no-tags', self.remote, '+refs/heads/*:refs/heads/*', remote=True)
+
+	def push(self, sha, branch):
+		self.git('push', '--quiet', self.remote, f'''{sha}:refs/heads/{branch}''', remote=True)
+		self.git('update-ref', f'''refs/heads/{branch}''', sha)
+		self.git('gc', '--auto', '--quiet') # Packs the loose objects from the backups now and then
+
+	def head(self, branch):
+		# sha of the branch head or None if the branch does not exist yet
+		try:
+			return self.git('rev-parse', '--verify', '--quiet', f'''refs/heads/{branch}^{{commit}}''').decode('ascii').strip()
+		except Exception:
+			return None
+
+	def headTime(self, branch):
+		# Time (UTC) of the last commit - the epoch if the branch is empty so that a backup is made
+		sha = self.head(branch)
+		if sha is None:
+			return datetime(1970, 1, 1, tzinfo=timezone.utc)
+		committed = self.git('log', '-1', '--format=%cI', sha).decode('ascii').strip()
+		return datetime.fromisoformat(committed).astimezone(timezone.utc)
+
+	def listFiles(self, branch):
+		# Same as list_files_in_repo - read from the mirror instead of Github
+		branch_files = {}
+		sha = self.head(branch)
+		if sha is None:
+			logMessage('info',f'''Branch {branch} is empty in {self.remote}''','',True)
+			return branch_files
+		logMessage('info',f'''Getting files in {self.path} from branch {branch}''','',True)
+		for entry in self.git('ls-tree', '-r', '-l', '-z', sha).split(b'\0'):
+			if entry == b'':
+				continue
+			info, path = entry.split(b'\t', 1)
+			mode, type, blob, size = info.decode('ascii').split()
+			if type == 'blob':
+				record = FileRecord(path.decode('utf-8'), int(size), sha = blob)
+				branch_files[record.path] = record
+		logger.debug(f'''{len(branch_files)} files in branch {branch}''')
+		return branch_files
 
-def backupFilesToBranch(repo, branch, branch_list,sourceFiles, backupTime):
-	addedfiles = []
-	updatedfiles = []
-	logger.info(f'''\nBacking up Files to {repo} branch {branch}''')
-	for item in sourceFiles:
-		action = backupFile(repo, branch, branch_list, backupTime, item)
+	def storeBlob(self, filecontent):
+		# Streams the content into the mirror - returns the blob sha
+		proc = subprocess.Popen(['git', 'hash-object', '-w', '--stdin'], env=self.env, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+		try:
+			for chunk in iter(lambda: filecontent.read(chunkSize), b''):
+				proc.stdin.write(chunk)
+		except BrokenPipeError:
+			pass # The error is reported below
+		out, err = proc.communicate()
+		if proc.returncode != 0:
+			raise Exception(f'''git hash-object failed - {err.decode('utf-8', 'replace').strip()}''')
+		return out.decode('ascii').strip()
+
+class MirrorBatch:
+	# CommitBatch for -sink mirror - blobs are written to the local mirror as they are staged
+	# The commit is built with a temporary index and pushed once
+	def __init__(self, mirror, branch):
+		self.mirror = mirror
+		self.branch = branch
+		self.elements = [] # update-index entries - one per added, updated or deleted file
+
+	def addFile(self, filepath, filecontent, oid = None):
+		filecontent.seek(0)
+		if oid is not None:
+			size = filecontent.seek(0, os.SEEK_END)
+			filecontent.seek(0)
+			uploadLfsObject(filecontent, oid, size)
+			filecontent = io.BytesIO(lfsPointer(oid, size))
+		sha = self.mirror.storeBlob(filecontent)
+		self.elements.append(f'''100644 {sha}\t{filepath}\0'''.encode('utf-8'))
+
+	def deleteFile(self, filepath):
+		self.elements.append(f'''0 {'0'*40}\t{filepath}\0'''.encode('utf-8'))
+
+	def hasChanges(self):
+		return self.elements != []
+
+	def commit(self, message):
+		parent = self.mirror.head(self.branch)
+		with tempfile.TemporaryDirectory() as tmp:
+			env = dict(self.mirror.env, GIT_INDEX_FILE=os.path.join(tmp, 'index'))
+			if parent is not None:
+				self.mirror.git('read-tree', parent, env=env)
+			self.mirror.git('update-index', '-z', '--index-info', input=b''.join(self.elements), env=env)
+			tree = self.mirror.git('write-tree', env=env).decode('ascii').strip()
+		args = ['commit-tree', tree, '-m', message]
+		if parent is not None:
+			args += ['-p', parent]
+		sha = self.mirror.git(*args).decode('ascii').strip()
+		self.mirror.push(sha, self.branch) # The branch is only moved if Github accepts the push
+		return sha
+
+gitMirror = None # Set for -sink mirror
+
+def newBatch(repository):
+	if gitMirror is not None:
+		return MirrorBatch(gitMirror, main)
+	return CommitBatch(repository, main)
+
+class FileRecord:
+	# One file on the printer or in Github
+	# __slots__ and a shared (interned) directory string keep large trees small in memory
+	__slots__ = ('dir', 'name', 'size', 'date', 'sha')
+
+	def __init__(self, path, size = None, date = None, sha = None):
+		dir, sep, name = path.rpartition('/')
+		self.dir = sys.intern(dir)
+		self.name = name
+		self.size = size
+		self.date = date
+		self.sha = sha
+
+	@property
+	def path(self):
+		if self.dir == '':
+			return self.name
+		return f'''{self.dir}/{self.name}'''
+
+class PrefixTrie:
+	# Matches a path against all the -noDelete dirs in one walk down the path
+	end = None # key that marks the end of a prefix
+
+	def __init__(self, prefixes):
+		self.root = {}
+		for prefix in prefixes:
+			node = self.root
+			for c in prefix:
+				node = node.setdefault(c, {})
+			node[self.end] = prefix
+
+	def match(self, path):
+		# Returns the shortest prefix of path or None - same as any(path.startswith(prefix))
+		node = self.root
+		for c in path:
+			if self.end in node:
+				break
+			node = node.get(c)
+			if node is None:
+				return None
+		return node.get(self.end)
+
+class BackupDiff:
+	# Compares the files on the printer with the files in Github
+	# Every check is a dict lookup - deletions are found in one pass over the Github files
+	keep = {'README.md', 'backup.json'} # Never deleted
+
+	def __init__(self):
+		self.repo = {} # path: FileRecord for the files in Github
+		self.source = {} # path: FileRecord for the files on the printer
+		self.added = []
+		self.updated = []
+		self.deleted = []
+		self.protected = [] # Not on the printer but in a -noDelete dir
+		self.errors = [] # Could not be backed up
+
+	def addSource(self, record):
+		self.source[record.path] = record
+
+	def compare(self, path, file_hash):
+		known = self.repo.get(path)
+		if known is None:
+			return 'Adding'
+		logger.debug(f'''\nGit Hash:  {known.sha}''')
+		logger.debug(f'''File Hash: {file_hash}''')
+		if known.sha != file_hash:
+			return 'Updating'
+		return 'Skipping'
+
+	def record(self, path, action):
 		if action == 'Adding':
-			addedfiles.append(item)
+			self.added.append(path)
 		elif action == 'Updating':
-			updatedfiles.append(item)
+			self.updated.append(path)
 		elif action == 'Error':
-			msg = f'''Uncaught error trying to backup {item}'''
-			logMessage('error',msg,'',True)
+			self.errors.append(path)
+
+	def findDeletions(self, protect):
+		# protect is a PrefixTrie of the -noDelete dirs
+		for path in self.repo:
+			if path in self.source or path in self.keep:
+				continue
+			if protect.match(path) is not None:
+				logger.debug(f'''{path} not deleted (noDelete {protect.match(path)})''')
+				self.protected.append(path)
+			else:
+				self.deleted.append(path)
+		return self.deleted
+
+def backupFilesToBranch(repo, batch, branch, dirs):
+	# Streaming pipeline - each stage runs at the same time, connected by bounded queues
+	# walk + filter -> fetch + hash (downloadWorkers threads) -> stage / upload
+	# The repo listing is fetched while the walk starts
+	# Returns a BackupDiff with the files found on the printer and the changes staged
+	diff = BackupDiff()
+	paths = queue.Queue(maxsize=1000) # names only
+	hashed = queue.Queue(maxsize=downloadWorkers*2) # holds file content - keeps memory flat
+
+	listed = {} # file: (size, date, sha) for the manifest
+	stop = threading.Event() # Set when any stage fails - the others give up instead of waiting on a queue
+
+	def put(q, item):
+		# Blocks while q is full - returns False if the pipeline has been stopped
+		while not stop.is_set():
+			try:
+				q.put(item, timeout=0.5)
+				return True
+			except queue.Full:
+				pass
+		return False
+
+	def get(q):
+		# Blocks while q is empty - returns None if the pipeline has been stopped
+		while not stop.is_set():
+			try:
+				return q.get(timeout=0.5)
+			except queue.Empty:
+				pass
+		return None
+
+	def walk():
+		walking = 0.0 # Time spent listing - not waiting for the fetch threads to catch up
+		start = began = time.monotonic()
+		try:
+			for entry in get_list_of_source_files(dirs):
+				walking += time.monotonic() - start
+				record = FileRecord(*entry)
+				diff.addSource(record) # Also protects files that are skipped below from deletion
+				if tooLarge(record.size): # Checked before download - the Github copy (if any) is kept
+					msg = f'''Skipping {entry[0]} - {record.size} bytes is more than -maxFileSize'''
+					logMessage('info',msg,'',False)
+					start = time.monotonic()
+					continue
+				if not put(paths, record):
+					break
+				start = time.monotonic()
+		except BaseException:
+			incompleteDirs.append('(walk stopped)') # Files not yet listed must not be deleted
+			stop.set()
+			raise
+		finally:
+			metrics.addTime('walk', walking + time.monotonic() - start)
+			trace.span('walk', 'walk', began, time.monotonic(), {'listing_seconds': round(walking + time.monotonic() - start, 3)})
+			for i in range(downloadWorkers):
+				put(paths, None) # One stop marker per fetch thread
+
+	def fetch():
+		try:
+			branch_list = listing.result()
+			while True:
+				record = get(paths)
+				if record is None:
+					break
+				item = record.path
+				known_hash = unchangedHash(item, record.size, record.date, branch_list)
+				if known_hash != '': # Same size and date as the copy already in Github
+					logger.debug(f'''Unchanged since last backup {item}''')
+					metrics.count('files_unchanged')
+					put(hashed, (record, known_hash, None, None))
+					continue
+				file_hash, filecontent, oid = getHash(item, size=record.size)
+				put(hashed, (record, file_hash, filecontent, oid))
+		except BaseException:
+			stop.set()
+			raise
+		finally:
+			put(hashed, None)
+
+	logger.info(f'''\nBacking up Files to {repo} branch {branch}''')
+	with ThreadPoolExecutor(max_workers=downloadWorkers+2) as pool:
+		listing = pool.submit(listRepository, repo, branch)
+		stages = [pool.submit(walk)] + [pool.submit(fetch) for i in range(downloadWorkers)]
+		try:
+			diff.repo = listing.result()
+			running = downloadWorkers
+			while running > 0:
+				result = get(hashed)
+				if stop.is_set():
+					break
+				if result is None:
+					running -= 1
+					continue
+				record, file_hash, filecontent, oid = result
+				item = record.path
+				action = stageFile(batch, diff, item, file_hash, filecontent, oid)
+				if file_hash != '':
+					record.sha = file_hash
+					listed[item] = (record.size, record.date, file_hash)
+				diff.record(item, action)
+				if action == 'Error':
+					msg = f'''Uncaught error trying to backup {item}'''
+					logMessage('error',msg,'',True)
+		except BaseException:
+			stop.set()
+			raise
+	for stage in stages: # Errors in the walk or fetch threads are not lost
+		stage.result()
+
+	manifest['files'] = listed # Files that are no longer on the printer drop out
+	return diff
+
+def unchangedHash(filepath, size, date, branch_list):
+	# Returns the Github hash if the file has not changed since it was last backed up
+	# Uses the size and date from the printer listing - no download needed
+	if fullScan or size is None or date is None:
+		return ''
+	known = manifest['files'].get(filepath)
+	if known is None or known[0] != size or known[1] != date:
+		return ''
+	if filepath not in branch_list or branch_list[filepath].sha != known[2]:
+		return '' # Github copy is not the one we recorded
+	return known[2]
+
+def loadManifest():
+	# The manifest records the size, date and hash of each file from the last backup
+	global manifest
+	key = f'''{userName}/{userRepo}/{main}'''
+	manifest = {'key': key, 'files': {}}
+	try:
+		with open(manifestfilename, 'r', encoding='utf-8') as f:
+			saved = json.load(f)
+		if saved.get('key') == key: # Ignore a manifest for a different repo or branch
+			manifest['files'] = {k: tuple(v) for k, v in saved['files'].items()}
+			logger.debug(f'''Loaded manifest with {len(manifest["files"])} files''')
+	except FileNotFoundError:
+		pass
+	except Exception as e:
+		msg = f'''Could not read manifest {manifestfilename} - all files will be checked'''
+		logMessage('info',msg,str(e),True)
 
-	return addedfiles, updatedfiles   
+def saveManifest():
+	try:
+		tempname = f'''{manifestfilename}.tmp'''
+		with open(tempname, 'w', encoding='utf-8') as f:
+			json.dump(manifest, f)
+		os.replace(tempname, manifestfilename) # Never leave a partly written manifest
+	except Exception as e:
+		msg = f'''Could not save manifest {manifestfilename}'''
+		logMessage('info',msg,str(e),True)
 	
-def downloadFile(file):
-	if reconnectPrinter():
-		commandUrl = f'''{printerUrl}/rr_download?name=''' 
-		code, payload = urlCall(commandUrl, file, False) # Get form
-		if code == 404:
-			msg = f'''Could not download file {file}'''
-			logMessage('info',msg,'',True)
-			return ''
-		
-		return payload
+class BlobHash:
+	# Git blob hash calculated a chunk at a time
+	# The git header needs the size first so the size from the printer listing is used
+	# For LFS the sha256 of the content is also calculated
+	def __init__(self, size = None, lfs = False):
+		self.expected = size
+		self.size = 0
+		self.seconds = 0.0 # Time spent hashing - for metrics
+		self.sha = None
+		self.sha256 = None
+		if size is not None:
+			self.sha = hashlib.sha1(f'''blob {size}\0'''.encode('ascii'))
+		if lfs:
+			self.sha256 = hashlib.sha256()
+
+	def update(self, chunk):
+		start = time.monotonic()
+		self.size += len(chunk)
+		if self.sha is not None:
+			self.sha.update(chunk)
+		if self.sha256 is not None:
+			self.sha256.update(chunk)
+		self.seconds += time.monotonic() - start
+
+	def hexdigest(self, spool):
+		metrics.addTime('hash', self.seconds)
+		if self.sha256 is not None: # Github holds the pointer file - not the content
+			return hash('LFS pointer', lfsPointer(self.sha256.hexdigest(), self.size))
+		if self.sha is not None and self.size == self.expected:
+			return self.sha.hexdigest()
+		# Size was not known (or the file changed) - hash again from the spool
+		spool.seek(0)
+		sha = hashlib.sha1(f'''blob {self.size}\0'''.encode('ascii'))
+		for chunk in iter(lambda: spool.read(chunkSize), b''):
+			sha.update(chunk)
+		return sha.hexdigest()
+
+	def lfsOid(self):
+		if self.sha256 is None:
+			return None
+		return self.sha256.hexdigest()
+
+def downloadFile(file, size = None):
+	# Streams the file from the printer into a spool - memory for small files, a temporary file for large ones
+	# Returns spool, hash, oid - spool is positioned at the start or is None if the file could not be downloaded
+	def consume(r):
+		expected = size
+		if expected is None and r.headers.get('Content-Length'):
+			expected = int(r.headers['Content-Length'])
+		return spoolChunks(r.iter_content(chunkSize), expected)
+
+	command = printer.downloadCommand(file)
+	code, payload = printer.request(command, consume) # Get form
+	if code != 200 or payload is None:
+		msg = f'''Could not download file {file}'''
+		logMessage('info',msg,'',True)
+		return None, '', None
 	
-def getHash(filepath, filecontent):
+	return payload
+
+def spoolChunks(chunks, size):
+	# Copies the chunks into a spool, hashing as it goes
+	# Returns spool, hash, oid - the spool is positioned at the start
+	blob = BlobHash(size, useLfs(size))
+	spool = tempfile.SpooledTemporaryFile(max_size=spoolMemoryLimit)
+	try:
+		for chunk in chunks:
+			spool.write(chunk)
+			blob.update(chunk)
+		file_hash = blob.hexdigest(spool)
+	except Exception:
+		spool.close()
+		raise
+	spool.seek(0)
+	return spool, file_hash, blob.lfsOid()
+
+def tooLarge(size):
+	# Files over the limit are skipped unless they can go to LFS
+	return not lfs and size is not None and size > maxFileSize
+
+def useLfs(size):
+	return lfs and size is not None and size > maxFileSize
+
+def lfsPointer(oid, size):
+	# The small file committed in place of the content
+	return f'''version https://git-lfs.github.com/spec/v1\noid sha256:{oid}\nsize {size}\n'''.encode('ascii')
+
+def uploadLfsObject(filecontent, oid, size):
+	# Upload to LFS storage using the batch API - nothing is sent if the object is already stored
+	url = f'''{lfsUrl}/objects/batch'''
+	headers = {'Accept': 'application/vnd.git-lfs+json', 'Content-Type': 'application/vnd.git-lfs+json'}
+	request = {'operation': 'upload', 'transfers': ['basic'], 'objects': [{'oid': oid, 'size': size}]}
+	session = getHttpSession(url)
+	start = time.monotonic()
+	r = session.post(url, json=request, headers=headers, auth=(userName, userToken), timeout=githubTimeout)
+	metrics.request('lfs', 'POST objects/batch', time.monotonic() - start, r.status_code, len(r.request.body or b''), len(r.content))
+	if r.status_code != 200:
+		raise Exception(f'''LFS batch request failed - code = {r.status_code} {r.text}''')
+	obj = r.json()['objects'][0]
+	if 'error' in obj:
+		raise Exception(f'''LFS rejected object - {obj['error'].get('message')}''')
+	actions = obj.get('actions', {})
+	if 'upload' in actions:
+		upload = actions['upload']
+		filecontent.seek(0)
+		start = time.monotonic()
+		r = getHttpSession(upload['href']).put(upload['href'], data=filecontent, headers=upload.get('header', {}), timeout=githubTimeout)
+		metrics.request('lfs', 'PUT upload', time.monotonic() - start, r.status_code, size, len(r.content))
+		if r.status_code not in [200,201]:
+			raise Exception(f'''LFS upload failed - code = {r.status_code} {r.text}''')
+	if 'verify' in actions:
+		verify = actions['verify']
+		start = time.monotonic()
+		r = getHttpSession(verify['href']).post(verify['href'], json={'oid': oid, 'size': size}, headers=dict(headers, **verify.get('header', {})), timeout=githubTimeout)
+		metrics.request('lfs', 'POST verify', time.monotonic() - start, r.status_code)
+		if r.status_code != 200:
+			raise Exception(f'''LFS verify failed - code = {r.status_code} {r.text}''')
+
+def getHash(filepath, filecontent = None, size = None):
+	# filecontent is bytes - if None it is downloaded from the printer
+	# Returns hash, content, oid - content is a binary file object positioned at the start
+	# oid is the LFS object id if the file is too large for Github and -lfs is set
 	file_hash = ''
-	if filecontent == '':  # This is the normal case
+	content = None
+	oid = None
+	if filecontent is None:  # This is the normal case
 		try:
+			file = filepath
 			if filepath.startswith('sd/'):
-				file = filepath.replace('sd/','/')
-			filecontent = downloadFile(file)
-			file_hash = hash(filepath,filecontent)
+				file = filepath.replace('sd/','/',1)
+			with metrics.phase('download', filepath): # Includes the hash - it is calculated as the file arrives
+				if localSource is not None:
+					content, file_hash, oid = localSource.read(filepath, size)
+				else:
+					content, file_hash, oid = downloadFile(file, size)
 		except Exception as e:
 			msg = f'''Could not get content of file {filepath}'''
 			logMessage('error',msg,str(e),True)
 			sendDuetGcode(f'''M291 S1 T0 P"{msg}"''')
 	else:
 		file_hash = hash(filepath,filecontent)
-	return file_hash , filecontent   
-
-def backupFile(repo, branch, branch_list, backupTime, filepath, filecontent = None):
-	if filecontent is None: # Done this way for safely against mutable variables
-		filecontent = ''
-	# if no filecontent file_hash will try to download the conetent
-	file_hash,filecontent = getHash(filepath,filecontent)
-
-	# Update github
+		content = io.BytesIO(filecontent)
+	return file_hash , content, oid
+
+def backupFile(batch, diff, filepath, filecontent = None):
+	# if no filecontent getHash will download the content
+	file_hash,filecontent,oid = getHash(filepath,filecontent)
+	return stageFile(batch, diff, filepath, file_hash, filecontent, oid)
+
+def stageFile(batch, diff, filepath, file_hash, filecontent, oid = None):
+	# Stage the change - Github is updated when the batch is committed
+	# oid is set if the file is stored with Git LFS
+	if file_hash == '': # Could not get the content - leave the Github copy alone
+		if filecontent is not None:
+			filecontent.close()
+		return 'Error'
+	action = diff.compare(filepath, file_hash) # against the blob sha from the branch listing
 	try:
-		action = ''
-		if filepath in branch_list:
-			contents = repo.get_contents(filepath, ref=branch)
-			logger.debug(f'''\nGit Hash:  {contents.sha}''')
-			logger.debug(f'''File Hash: {file_hash}''')
-
-			if contents.sha != file_hash:  #file has changed
-				action = 'Updating'
-				logger.info(f'''{action} {filepath}''')
-				repo.update_file(contents.path, backupTime, filecontent, contents.sha, branch=branch)
-
-			else:
-				action = 'Skipping'
-				logger.debug(f'''{action} {filepath}''')
-		else:
-			action = 'Adding'
+		if action == 'Skipping':
+			logger.debug(f'''{action} {filepath}''')
+		else: # new or changed
 			logger.info(f'''{action} {filepath}''')
-			repo.create_file(filepath, "Original", filecontent, branch=branch)
+			with metrics.phase('upload', filepath):
+				if isinstance(filecontent, LocalFile): # Hashed in place - upload a copy
+					filecontent, copied, oid = filecontent.copy()
+					if copied != file_hash: # Written to since it was hashed
+						logger.debug(f'''{filepath} changed while being backed up''')
+						action = diff.compare(filepath, copied)
+				if action != 'Skipping':
+					batch.addFile(filepath, filecontent, oid)
    
 	except Exception as e:
 		msg = f'''Github error applying {action} to file {filepath}'''
 		logMessage('error',msg,str(e),True)
 		sendDuetGcode(f'''M291 S1 T0 P"{msg}"''')
 		action = 'Error'
+	finally:
+		if filecontent is not None:
+			filecontent.close() # Removes any temporary file
 	return action
 
-def removeDeletedFiles(repo, mainbranch, main_files,sourceFiles, backupTime):
-	deletedfiles = []
+def removeDeletedFiles(batch, mainbranch, diff):
 	msg = f'''Delete unnecessary files from branch {mainbranch}'''
 	logMessage('info',msg,'',True)
-	for fileurl in main_files:
-		if fileurl == 'README.md':  # Never delete 
-			continue
-		#Decide if it should be deleted
-		protectedDir = False
-		if fileurl not in sourceFiles: # A delete candidate		
-			if noDelete != [] : # i.e. have to consider noDelete dirs
-				for ignore_delete in noDelete: # Dont delete files in specified directories
-					if fileurl.startswith(ignore_delete[0]): # file is in delete protected dir
-						logger.debug(f'''{fileurl} not deleted (noDelete {ignore_delete[0]})''')
-						protectedDir = True
-						break # inner loop		
-			if protectedDir:
-				continue # Dont delete - check next file
-			
-			# Delete file
-			try:
-				contents = repo.get_contents(fileurl, ref=mainbranch)
-				repo.delete_file(contents.path, backupTime , contents.sha, branch=mainbranch)
-				logger.info(f'''Deleted {fileurl}''')
-				deletedfiles.append(fileurl)
-			except Exception as e:
-				msg = f'''Error trying to delete {contents.path}'''
-				logMessage('error',msg,str(e),True)
-				sendDuetGcode(f'''M291 S1 T0 P"{msg}"''')
-
-	return deletedfiles
+	protect = PrefixTrie([x[0] for x in noDelete]) # Dont delete files in specified directories
+	for fileurl in diff.findDeletions(protect):
+		# Delete file - removed from the tree when the batch is committed
+		logger.info(f'''Deleting {fileurl}''')
+		batch.deleteFile(fileurl)
+	if len(diff.protected) > 0:
+		logger.info(f'''{len(diff.protected)} file(s) not deleted because of -noDelete''')
+
+	return diff.deleted
+
+def commitBackup(batch, backupTime):
+	# Apply all staged changes as one commit
+	if not batch.hasChanges():
+		logger.info('''No changes to commit''')
+		return True
+	try:
+		sha = batch.commit(backupTime)
+		logger.info(f'''Committed {len(batch.elements)} change(s) as {sha}''')
+		return True
+	except Exception as e:
+		msg = f'''Github error committing backup to branch {batch.branch}'''
+		logMessage('error',msg,str(e),True)
+		sendDuetGcode(f'''M291 S1 T0 P"{msg}"''')
+		return False
 
 def hash(f, content):
+	# Git blob hash - content is the raw bytes of the file
 	try:
-		#size = len(content.encode('utf-8'))  #string must be encoded as bytes
-		size = len(content)  #string must be encoded as bytes
-		githeader = f'''blob {size}\0'''
-		githeader = bytes(githeader,'utf-8')
-		file_hash = hashlib.sha1()
-		file_hash.update(githeader)
-		file_hash.update(content.encode('utf-8')) # Content must be encoded as bytes
+		githeader = f'''blob {len(content)}\0'''
+		file_hash = hashlib.sha1(githeader.encode('ascii'))
+		file_hash.update(content)
 		hash = file_hash.hexdigest()
 	except Exception as e:
 		msg = f'''Could not calculate hash for {f}'''
@@ -637,49 +2278,245 @@ def hash(f, content):
 		return ''
 	return hash
 
-def update_readme(repository, main, main_files, addedfiles, updatedfiles, deletedfiles):
-	# Update dates and times in README.md
+def update_readme(batch, main, diff):
+	# Update dates and times in README.md and the summary in backup.json
+	if readmeOnChange and not batch.hasChanges():
+		logger.info('''No files changed - README.md not updated''')
+		return
 	local_backup_dt = datetime.now()
+	utc_backup_dt = local_backup_dt - timedelta(seconds = TimeZoneOffset)
+	readme, summary = buildReport(main, diff, local_backup_dt, utc_backup_dt)
+	backupFile(batch, diff, 'README.md', readme.encode('utf-8'))
+	backupFile(batch, diff, 'backup.json', summary.encode('utf-8'))
+
+def buildReport(main, diff, local_backup_dt, utc_backup_dt):
+	# Returns the README.md text and a JSON summary of the backup
+	# The parts are collected in a list and joined once
 	local_backup_str = local_backup_dt.strftime('%d %b %Y at %H:%M')
-	utc_backup_dt = datetime.now() - timedelta(seconds = TimeZoneOffset)
 	utc_backup_str = utc_backup_dt.strftime('%d %b %Y at %H:%M')
 
 	'''
 	Note the use of \n in markdown for the headings and <br> for line-by-line
 	'''
 	
-	filecontent = f'''# Last backup was:\n'''
-	filecontent = filecontent + f'''## {local_backup_str} Local Time (TZ = {TimeZoneOffsetHrs:+.1f} hrs)  \n'''
-	filecontent = filecontent + f'''## {utc_backup_str} UTC \n'''
-
-	filecontent = filecontent + f'''\n'''
-	
-	if len(addedfiles) > 0:
-		filecontent = filecontent + f'''### The following files were added:\n'''
-		for file in addedfiles:
-			filecontent = filecontent + f'''{file}<br>'''
-	else:
-		filecontent = filecontent + f'''### No files were added.\n'''
-
-	filecontent = filecontent + f'''\n'''
+	parts = [f'''# Last backup was:\n''',
+		f'''## {local_backup_str} Local Time (TZ = {TimeZoneOffsetHrs:+.1f} hrs)  \n''',
+		f'''## {utc_backup_str} UTC \n''']
+
+	for action, files in (('added', diff.added), ('updated', diff.updated), ('deleted', diff.deleted)):
+		parts.append(f'''\n''')
+		if len(files) > 0:
+			parts.append(f'''### The following files were {action}:\n''')
+			parts.extend(f'''{file}<br>''' for file in files)
+		else:
+			parts.append(f'''### No files were {action}.\n''')
+
+	summary = {
+		'version': progVersion,
+		'branch': main,
+		'local_time': local_backup_dt.isoformat(timespec='seconds'),
+		'utc_time': utc_backup_dt.isoformat(timespec='seconds') + 'Z',
+		'timezone_hours': TimeZoneOffsetHrs,
+		'files': len(diff.source),
+		'added': diff.added,
+		'updated': diff.updated,
+		'deleted': diff.deleted,
+		'errors': diff.errors,
+		'incomplete_dirs': incompleteDirs
+		}
+	return ''.join(parts), json.dumps(summary, indent=1)
+
+class Inotify:
+	# Minimal Linux inotify binding using ctypes
+	IN_CLOSE_WRITE = 0x00000008
+	IN_MOVED_FROM = 0x00000040
+	IN_MOVED_TO = 0x00000080
+	IN_CREATE = 0x00000100
+	IN_DELETE = 0x00000200
+	IN_Q_OVERFLOW = 0x00004000
+	IN_IGNORED = 0x00008000
+	IN_ISDIR = 0x40000000
+	IN_CLOEXEC = 0o2000000
+	mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+	header = struct.Struct('iIII') # wd, mask, cookie, name length
+
+	def __init__(self):
+		libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+		self.addWatch = libc.inotify_add_watch
+		self.addWatch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+		self.fd = libc.inotify_init1(self.IN_CLOEXEC)
+		if self.fd < 0:
+			raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+		self.watches = {} # watch descriptor: local directory
+
+	def watch(self, path):
+		wd = self.addWatch(self.fd, os.fsencode(path), self.mask)
+		if wd < 0:
+			error = ctypes.get_errno()
+			raise OSError(error, f'''Cannot watch {path} - {os.strerror(error)}''')
+		self.watches[wd] = path
+
+	def read(self, timeout):
+		# Returns a list of (directory, name, mask) - empty if nothing happened within timeout seconds
+		# directory is None if events were lost (queue overflow)
+		ready, _, _ = select.select([self.fd], [], [], timeout)
+		if not ready:
+			return []
+		data = os.read(self.fd, 64*1024)
+		events = []
+		offset = 0
+		while offset < len(data):
+			wd, mask, cookie, length = self.header.unpack_from(data, offset)
+			offset += self.header.size
+			name = os.fsdecode(data[offset:offset+length].rstrip(b'\0'))
+			offset += length
+			if mask & self.IN_IGNORED: # Directory removed
+				self.watches.pop(wd, None)
+				continue
+			events.append((self.watches.get(wd), name, mask))
+		return events
+
+	def close(self):
+		os.close(self.fd)
+
+class ChangeWatcher:
+	# Watches the -dir trees under -sdRoot and collects the files that change
+	# Paths are kept in the same form as the printer listing e.g. sd/sys/config.g
+	def __init__(self, root):
+		self.root = root
+		self.source = LocalSource(root) # Changed files are read the same way as by the walk
+		self.inotify = Inotify()
+		self.changed = set()
+		self.rescan = False # Changes were lost - a full backup is needed
+		for dir in dirs:
+			self.addTree(self.localPath(dir[0].rstrip('/')))
+		logger.info(f'''Watching {len(self.inotify.watches)} directories for changes''')
 
-	if len(updatedfiles) > 0:
-		filecontent = filecontent + f'''### The following files were updated:\n'''
-		for file in updatedfiles:
-			filecontent = filecontent + f'''{file}<br>'''
-	else:
-		filecontent = filecontent + f'''### No files were updated.\n'''
+	def sdPath(self, local):
+		return f'''sd{local[len(self.root):]}'''
 
-	filecontent = filecontent + f'''\n'''
+	def localPath(self, path):
+		return f'''{self.root}{path[2:]}''' # path starts with sd
 
-	if len(deletedfiles) > 0:
-		filecontent = filecontent + f'''### The following files were deleted:\n'''
-		for file in deletedfiles:
-			filecontent = filecontent + f'''{file}<br>'''
-	else:
-		filecontent = filecontent + f'''### No files were deleted \n'''
+	def addTree(self, local, scan = False):
+		# Watch local and every directory below it that is not ignored
+		# scan - the directory is new so the files already in it have changed as well
+		if ignoreMatcher.pruneDir(self.sdPath(local)):
+			return
+		for top, subdirs, files in os.walk(local):
+			try:
+				self.inotify.watch(top)
+			except OSError as e:
+				logMessage('error','Changes will only be found by the next full backup',str(e),True)
+			subdirs[:] = [x for x in subdirs if not ignoreMatcher.pruneDir(self.sdPath(os.path.join(top, x)))]
+			if scan:
+				self.changed.update(self.sdPath(os.path.join(top, x)) for x in files)
+
+	def collect(self, timeout):
+		# Waits up to timeout seconds (None - forever) for a change
+		# Then keeps collecting until nothing has changed for -watchDelay seconds
+		events = self.inotify.read(timeout)
+		if events == []:
+			return
+		deadline = time.time() + watchDelay*12 # A file that is written continuously is not held back forever
+		while events != []:
+			for dir, name, mask in events:
+				if dir is None or mask & Inotify.IN_Q_OVERFLOW:
+					self.rescan = True
+					continue
+				local = os.path.join(dir, name)
+				if mask & Inotify.IN_ISDIR:
+					if mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+						self.addTree(local, scan = True)
+					elif mask & Inotify.IN_MOVED_FROM: # The files in it are gone but no event is sent for them
+						self.rescan = True
+					continue
+				path = self.sdPath(local)
+				if ignoreMatcher.ignored(path): # e.g. the manifest being saved - would start another backup
+					continue
+				self.changed.add(path)
+			if time.time() > deadline:
+				break
+			events = self.inotify.read(watchDelay)
+
+	def close(self):
+		self.inotify.close()
+
+def startWatch():
+	# Returns a ChangeWatcher or None if the SD card is not local or inotify is not available
+	if not os.path.isdir(sdRoot):
+		msg = f'''-watch needs the SD card files in {sdRoot} - backups will run on the interval only'''
+		logMessage('error',msg,'',True)
+		return None
+	try:
+		return ChangeWatcher(sdRoot)
+	except Exception as e:
+		msg = 'Could not watch for changes - backups will run on the interval only'
+		logMessage('error',msg,str(e),True)
+		return None
 
-	backupFile(repository, main, main_files, utc_backup_str, 'README.md', filecontent)
+def watchForChanges(repository, watcher, lastRun):
+	# Backs up changed files as they are written until the next full backup is due
+	# Returns the time for the full backup commit
+	while True:
+		timeout = None # No full backups after the first if there is no interval
+		if backupInt > 0:
+			timeout = (lastRun + timedelta(hours=backupInt) - datetime.now()).total_seconds()
+			if timeout <= 0:
+				break
+		watcher.collect(timeout)
+		if watcher.rescan:
+			logMessage('info','Lost track of some changes - starting a full backup','',True)
+			break
+		if len(watcher.changed) > 0:
+			changed = sorted(watcher.changed)
+			watcher.changed.clear()
+			backupChangedFiles(repository, watcher, changed)
+	return (datetime.now() - timedelta(seconds = TimeZoneOffset)).strftime('%d %b %Y %H:%M')
+
+def backupChangedFiles(repository, watcher, changed):
+	# Back up the files the watch found - one commit for all of them
+	backupTime = (datetime.now() - timedelta(seconds = TimeZoneOffset)).strftime('%d %b %Y %H:%M')
+	metrics.reset()
+	trace.reset()
+	msg = f'''Backing up {len(changed)} changed file(s)'''
+	logMessage('info',msg,'',True)
+	batch = newBatch(repository)
+	diff = BackupDiff()
+	diff.repo = listRepository(repository, main)
+	protect = PrefixTrie([x[0] for x in noDelete if x != []]) # -noDelete without a directory is [[]]
+	for path in changed:
+		if ignoreMatcher.ignoredPath(path):
+			continue
+		local = watcher.localPath(path)
+		if os.path.isfile(local):
+			record = FileRecord(path, os.path.getsize(local))
+			diff.addSource(record)
+			if tooLarge(record.size):
+				logMessage('info',f'''Skipping {path} - {record.size} bytes is more than -maxFileSize''','',False)
+				continue
+			with metrics.phase('download', path):
+				try:
+					content, file_hash, oid = watcher.source.read(path)
+				except Exception as e:
+					logMessage('info',f'''Could not read file {local}''',str(e),True)
+					content, file_hash, oid = None, '', None
+			diff.record(path, stageFile(batch, diff, path, file_hash, content, oid))
+			manifest['files'].pop(path, None) # The next full backup checks it again
+		elif path in diff.repo and noDelete != [[]] and protect.match(path) is None:
+			logger.info(f'''Deleting {path}''')
+			batch.deleteFile(path)
+			diff.deleted.append(path)
+	with metrics.phase('readme'):
+		update_readme(batch, main, diff)
+	with metrics.phase('commit'):
+		committed = commitBackup(batch, backupTime)
+	if committed:
+		saveManifest()
+	githubCache.save()
+	metrics.setFiles(diff)
+	metrics.write(committed)
+	trace.write()
 
 def checkPythonVersion():
 	logger.debug(f'''Python version is {sys.version_info.major}.{sys.version_info.minor}''')
@@ -708,9 +2545,8 @@ def Main():
 	signal.signal(signal.SIGINT, sig_handler)
 	signal.signal(signal.SIGTERM, sig_handler)
 
-	global sessionKey, printerUrl, TimeZoneOffset, TimeZoneOffsetHrs, logger
+	global printer, printerUrl, TimeZoneOffset, TimeZoneOffsetHrs, logger, gitMirror
 	global deleteFiles
-	sessionKey = {} # session key if password used
 	deleteFiles = True
 
 	
@@ -720,10 +2556,12 @@ def Main():
 	setupLogfile()
 	logger.info('Initial logfile started')
 	logger.info(f'''{progName} -- {progVersion}''')
+	printer = connectPrinter() # One session reused for all printer calls
 
 	check_for_mandatory()
 	check_for_alias()
 	checkPythonVersion()
+	selectSource()
 
 	# Get time zone info
 	TimeZoneOffset = datetime.now().astimezone().utcoffset().total_seconds()
@@ -731,26 +2569,45 @@ def Main():
 	TimeZoneOffsetHrs = TimeZoneOffset/3600
 	logger.info(f'''Time Zone Offset Hours = {TimeZoneOffsetHrs:+.1f}''')
 
-	# Log into Github repo and get last commit date
-	repository, last_commit_git = loginGithub(userName, userToken, userRepo)
-	if repository is None:
-		msg = f'''Could not access {userRepo}'''
-		logMessage('critical',msg,'',True)
-		force_quit(1)
+	# Log into Github repo - the same client is used for every backup
+	githubCache.load()
+	repository = loginGithub(userName, userToken, userRepo)
+	if sink == 'mirror':
+		try:
+			gitMirror = GitMirror(mirrorPath, remoteUrl)
+		except Exception as e:
+			msg = f'''Could not create local mirror {mirrorPath}'''
+			logMessage('critical',msg,str(e),True)
+			sendDuetGcode(f'''M291 S1 T0 P"{msg}"''')
+			force_quit(1)
 		
+	lastRun = None # local time of the last backup run
+	watcher = None
 	while True:
-		backupTime = wait_until_backup_needed(last_commit_git, backupInt) # wait until backup needed
+		metrics.reset()
+		with metrics.phase('login'):
+			last_commit_utc = lastBackupTime(repository) # Also checks the token
+		if watcher is not None and lastRun is not None:
+			backupTime = watchForChanges(repository, watcher, lastRun) # until a full backup is needed
+			metrics.reset() # The changes found by the watch have been reported
+			if watcher.rescan:
+				watcher.close()
+				watcher = None # Started again after the full backup
+		elif watch and lastRun is None:
+			# The watch starts with a full backup - waiting for the interval would miss changes until then
+			logger.info('Watching for changes - full backup starting now')
+			backupTime = (datetime.now() - timedelta(seconds = TimeZoneOffset)).strftime('%d %b %Y %H:%M')
+		else:
+			with metrics.phase('wait'):
+				backupTime = wait_until_backup_needed(last_commit_utc, backupInt, lastRun) # wait until backup needed
+		trace.reset() # The timeline starts when the backup does
 		
 		setupLogfile()
 		
 		logger.info('New logfile started')
 		logger.info(f'''{progName} -- {progVersion}''') 
 
-		main_Files = [] # Files already in Github
-		source_Files = [] # Files to be backed up
-		added_Files = [] # Files added added to Github
-		updated_Files = [] # Files updated in Github
-		deleted_Files = [] # Files removed from Github
+		incompleteDirs.clear() # Directories the printer could not fully list
 
 		if backupInt == 0:
 			msg = "Single backup starting."
@@ -760,40 +2617,58 @@ def Main():
 
 		logger.info(msg)
 
-		# Log into Github again because considerable time may have elapsed
-		repository, last_commit_git = loginGithub(userName, userToken, userRepo)
-		if repository is None:
-			msg = f'''Could not access {userRepo}'''
-			logMessage('critical',msg,'',True)
-			sendDuetGcode(f'''M291 S1 T0 P"{msg}"''')
-			force_quit(1)
-
 		list_options()
+		if watch and watcher is None:
+			watcher = startWatch() # Before the walk so that no change is missed
 
-		# Get list of files in didirectories to be backed up
-		source_Files = get_list_of_source_files(dirs)
+		# All changes are collected and then committed together
+		committed = False
+		batch = newBatch(repository)
+		loadManifest()
+		if gitMirror is None:
+			githubScheduler.predict(len(manifest['files']))
 
-		if source_Files != []: # will be empty if printer disconnected
+		# Walk the directories to be backed up and stage changed files
+		diff = backupFilesToBranch(repository, batch, main, dirs)
 
-			# get a list of all files in the repo
-			main_Files = list_files_in_repo(repository, main)
+		if diff.source: # will be empty if printer disconnected
 
-			added_Files, updated_Files = backupFilesToBranch(repository,main, main_Files, source_Files,backupTime)
-
-			if noDelete != [[]]: # Delete unnecessary files
-				deleted_Files = removeDeletedFiles(repository,main, main_Files,source_Files, backupTime)
+			if incompleteDirs != []: # Missing files may only be missing from the listing
+				msg = f'''No Deletions - could not list {', '.join(incompleteDirs)}'''
+				logMessage('info',msg,'',True)
+			elif noDelete != [[]]: # Delete unnecessary files
+				with metrics.phase('delete'):
+					removeDeletedFiles(batch, main, diff)
 			else:
 				msg = f'''No Deletions requested'''
 				logMessage('info',msg,'',True)
 
-			update_readme(repository, main, main_Files, added_Files, updated_Files, deleted_Files)
+			with metrics.phase('readme'):
+				update_readme(batch, main, diff)
+
+			with metrics.phase('commit'):
+				committed = commitBackup(batch, backupTime)
+			if committed:
+				saveManifest()
+			if gitMirror is None:
+				githubScheduler.report()
+			githubCache.save()
+			lastRun = datetime.now()
+		metrics.setFiles(diff)
+		metrics.set('incomplete_dirs', len(incompleteDirs))
+		if githubScheduler.remaining is not None:
+			metrics.set('github_rate_remaining', githubScheduler.remaining)
+		metrics.write(bool(diff.source) and committed)
+		trace.write()
 		
-		if backupInt == 0:
+		if backupInt == 0 and (watcher is None or not diff.source):
 			msg = 'Exiting normally after single backup'
 			logMessage('info',msg,'',True)
 			sendDuetGcode(f'''M291 S1 T0 P"{msg}"''')
+			printer.disconnect()
 			break
-		if source_Files == []:
+		printer.disconnect() # Free the connection slot until the next backup
+		if not diff.source:
 			#Likely could not connect
 			recheck = int(backupInt*3600 / 4) # backupInt is hours
 			rechecktime = timedelta(seconds = recheck).split(':')